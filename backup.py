@@ -0,0 +1,177 @@
+import argparse
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+from datetime import datetime
+
+from migrations import MIGRATIONS, schema_version
+
+
+# Backups are gzipped copies of a ladder's database named <stem>-<UTC time>.db.gz, e.g.
+# backups/players-20240131T120000Z.db.gz. They are taken with SQLite's online backup API
+# from a connection of their own, so the bot keeps reading and writing meanwhile.
+
+STAMP = '%Y%m%dT%H%M%SZ'
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def list_backups(path, directory):
+    """[(taken at, file)] of the backups of the database at path, oldest first."""
+    pattern = re.compile(re.escape(_stem(path)) + r'-(\d{8}T\d{6}Z)\.db\.gz')
+    backups = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            match = pattern.fullmatch(name)
+            if match:
+                backups.append((datetime.strptime(match.group(1), STAMP), os.path.join(directory, name)))
+    return sorted(backups)
+
+
+def take_backup(path, directory, keep=8, pages=256, pause=0.005, now=None):
+    """Copy the database at path into a new compressed backup and drop all but the newest `keep`.
+
+    Blocks until done, so run it off the event loop. The copy is made `pages`
+    pages at a time, sleeping `pause` seconds in between so the writer is never
+    held up for long, from a read transaction held open throughout: in WAL mode
+    that pins one consistent version of the database, and commits made
+    meanwhile neither block the copy nor restart it. Returns (file, bytes).
+    """
+    now = now or datetime.utcnow()
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, f'{_stem(path)}-{now.strftime(STAMP)}.db.gz')
+    copy = f'{target}.tmp.db'
+    try:
+        source = sqlite3.connect(path, isolation_level=None)
+        destination = sqlite3.connect(copy, isolation_level=None)
+        try:
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(destination, pages=pages, sleep=pause)
+            source.execute('COMMIT')
+            # A standalone file: no -wal next to it to lose when it's compressed
+            destination.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            source.close()
+            destination.close()
+        verify(copy)
+
+        with open(copy, 'rb') as raw, gzip.open(f'{target}.tmp', 'wb', compresslevel=6) as compressed:
+            shutil.copyfileobj(raw, compressed, 1 << 20)
+        os.replace(f'{target}.tmp', target)
+    finally:
+        for leftover in (copy, f'{target}.tmp'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    for _, old in list_backups(path, directory)[:-keep]:
+        os.remove(old)
+    return target, os.path.getsize(target)
+
+
+def verify(path):
+    """Check that the file is an intact ladder database this bot can open.
+
+    Returns (players, matches, last match epoch or None); raises ValueError otherwise.
+    """
+    try:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    except sqlite3.Error as e:
+        raise ValueError(f'cannot open {path}: {e}')
+    try:
+        problems = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        if problems != ['ok']:
+            raise ValueError(f"integrity check failed: {'; '.join(problems[:5])}")
+        version = schema_version(conn)
+        if not 1 <= version <= len(MIGRATIONS):
+            raise ValueError(f'schema version {version} is not one this bot knows (1 to {len(MIGRATIONS)})')
+        players = conn.execute('SELECT COUNT(*) FROM players').fetchone()[0]
+        matches, last_match = conn.execute('SELECT COUNT(*), MAX(played_at) FROM matches').fetchone()
+        return players, matches, last_match
+    except sqlite3.Error as e:
+        raise ValueError(f'not a usable ladder database: {e}')
+    finally:
+        conn.close()
+
+
+def prepare_restore(path, directory, at=None):
+    """Unpack and verify the newest backup taken at or before `at` (default: the newest).
+
+    The database goes to <path>.restore, ready for replace_database(). Returns
+    (taken at, backup file, verify() result); raises ValueError if there is no
+    such backup or it fails verification.
+    """
+    candidates = [backup for backup in list_backups(path, directory) if at is None or backup[0] <= at]
+    if not candidates:
+        raise ValueError(f'no backup of {path} in {directory}' + (f' taken at or before {at:%Y-%m-%d %H:%M:%S} UTC' if at else ''))
+    taken_at, backup = candidates[-1]
+    restore_path = f'{path}.restore'
+    try:
+        with gzip.open(backup, 'rb') as compressed, open(restore_path, 'wb') as raw:
+            shutil.copyfileobj(compressed, raw, 1 << 20)
+        summary = verify(restore_path)
+    except (OSError, EOFError) as e:
+        os.remove(restore_path)
+        raise ValueError(f'cannot unpack {backup}: {e}')
+    except ValueError:
+        os.remove(restore_path)
+        raise
+    return taken_at, backup, summary
+
+
+def replace_database(path, restore_path):
+    """Swap the database prepared by prepare_restore() in at path. Nothing may have path open.
+
+    The replaced database is kept as <path>.before-restore.
+    """
+    if os.path.exists(path):
+        # Fold the WAL into the main file, so the kept copy is complete on its own
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            conn.close()
+        os.replace(path, f'{path}.before-restore')
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(restore_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Back up, list or restore the backups of a ladder database.')
+    parser.add_argument('action', choices=['backup', 'list', 'restore'])
+    parser.add_argument('database', nargs='?', default='players.db')
+    parser.add_argument('--dir', default='backups', help='backup directory (backup_dir in ladder.py)')
+    parser.add_argument('--keep', type=int, default=8, help='backups to keep when taking one')
+    parser.add_argument('--at', type=datetime.fromisoformat, default=None, metavar='UTC_TIME',
+                        help='restore the newest backup taken at or before this time, e.g. 2024-01-31T12:00')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.action == 'backup':
+        target, size = take_backup(args.database, args.dir, args.keep)
+        logging.info(f'Backed up {args.database} to {target} ({size / 2**20:.1f} MB).')
+    elif args.action == 'list':
+        for taken_at, backup in list_backups(args.database, args.dir):
+            print(f'{taken_at:%Y-%m-%d %H:%M:%S}  {os.path.getsize(backup):>12}  {backup}')
+    else:
+        # Stop the bot first; it keeps the database open
+        try:
+            taken_at, backup, (players, matches, _) = prepare_restore(args.database, args.dir, args.at)
+        except ValueError as e:
+            raise SystemExit(f'Not restored: {e}')
+        replace_database(args.database, f'{args.database}.restore')
+        if os.path.exists(f'{args.database}.players'):
+            os.remove(f'{args.database}.players')
+        logging.info(f'Restored {args.database} from {backup} ({players} players, {matches} matches); '
+                     f'the replaced database is {args.database}.before-restore.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from migrations import migrate
+from periods import to_epoch
+
+
+# Offline load test for the command handlers. The bot is imported against a
+# temporary database seeded with a synthetic ladder, and each command's coroutine
+# is driven with stand-ins for discord's ctx and Member; nothing talks to Discord.
+#
+#   python benchmark.py --players 100000 --matches 500000 --output before.json
+#   python benchmark.py --players 100000 --matches 500000 --baseline before.json
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class FakeMember:
+    def __init__(self, discord_id):
+        self.id = discord_id
+        self.name = f'player{discord_id}'
+        self.display_name = self.name
+        self.mention = f'<@{discord_id}>'
+        self.roles = []
+
+
+class FakeContext:
+    def __init__(self, author, channel_id):
+        self.author = author
+        self.channel = FakeChannel(channel_id)
+        self.guild = None
+        self.sent = []
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent.append(embed.description if embed is not None else content)
+
+
+class ErrorCounter(logging.Handler):
+    # The commands log and swallow their exceptions; count them instead
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class QueryCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.transaction_control = 0
+
+    def __call__(self, sql):
+        control = sql.split(None, 1)[0].upper() in ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+        with self._lock:
+            if control:
+                self.transaction_control += 1
+            else:
+                self.queries += 1
+
+    def reset(self):
+        with self._lock:
+            self.queries = self.transaction_control = 0
+
+
+def seed(path, players, matches, rnd, chunk_size=50000):
+    """Fill a fresh database with `players` players and `matches` historic matches."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrate(conn)
+    now = datetime.utcnow()
+    rating = np.random.default_rng(rnd.randrange(2 ** 32)).normal(1500, 200, players)
+
+    conn.execute('BEGIN')
+    for start in range(0, players, chunk_size):
+        rows = []
+        names = []
+        for i in range(start, min(start + chunk_size, players)):
+            discord_id = i + 1
+            played = rnd.randrange(0, 200)
+            wins = rnd.randint(0, played)
+            draws = rnd.randint(0, played - wins)
+            last_match = now - timedelta(seconds=rnd.randrange(180 * 24 * 3600))
+            rows.append((discord_id, float(rating[i]), rnd.uniform(50, 350), 0.06, to_epoch(last_match), played,
+                         wins, played - wins - draws, draws, to_epoch(last_match)))
+            names.append((discord_id, f'player{discord_id}', time.time()))
+        conn.executemany('INSERT INTO players (discord_id, rating, rd, vol, last_match, matches_played, wins, losses, draws, rd_updated) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.executemany('INSERT INTO usernames (discord_id, name, fetched_at) VALUES (?, ?, ?)', names)
+
+    played_at = now - timedelta(days=365)
+    step = timedelta(days=365) / max(matches, 1)
+    for start in range(0, matches, chunk_size):
+        rows = []
+        for _ in range(start, min(start + chunk_size, matches)):
+            a, b = rnd.sample(range(1, players + 1), 2) if players > 1 else (1, 1)
+            played_at += step
+            rows.append((a, b, rnd.choice('wld'), to_epoch(played_at), 1500.0, 100.0, 1505.0, 98.0, 1500.0, 100.0, 1495.0, 98.0))
+        conn.executemany('INSERT INTO matches (reporter_id, opponent_id, result, played_at, '
+                         'reporter_rating_before, reporter_rd_before, reporter_rating_after, reporter_rd_after, '
+                         'opponent_rating_before, opponent_rd_before, opponent_rating_after, opponent_rd_after) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def summarize(latencies, wall, errors, counter):
+    calls = len(latencies)
+    latencies = np.array(latencies) * 1000
+    return {
+        'calls': calls,
+        'errors': errors,
+        'throughput_per_s': calls / wall if wall else None,
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'queries_per_call': counter.queries / calls,
+        'transaction_statements_per_call': counter.transaction_control / calls,
+    }
+
+
+async def run_phase(ladder, calls, concurrency, errors, counter):
+    """Run the call factories with `concurrency` workers; returns (latencies, wall time, errors)."""
+    # Let background writes of the previous phase land before counting this one's
+    await ladder.db.transaction(lambda conn: None)
+    counter.reset()
+    errors.count = 0
+    latencies = []
+    calls = iter(calls)
+
+    async def worker():
+        for call in calls:
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    await ladder.db.transaction(lambda conn: None)
+    return latencies, wall, errors.count
+
+
+async def benchmark(bot_module, players, iterations, concurrency, rnd):
+    # The first configured ladder, whose database is the seeded players.db
+    ladder = bot_module.LADDERS[0]
+    channel = ladder.channel_id
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    counter = QueryCounter()
+    ladder.db.set_trace(counter)
+
+    started = time.perf_counter()
+    await bot_module.load_rank_index(ladder)
+    setup = {'load_rank_index_s': time.perf_counter() - started}
+
+    def command(name, author, *args):
+        callback = getattr(bot_module, name).callback
+        return lambda: callback(FakeContext(FakeMember(author), channel), *args)
+
+    def random_player():
+        return rnd.randint(1, players)
+
+    # Disjoint pairs, so concurrent reports never meet in the same pending slot
+    pair_ids = rnd.sample(range(1, players + 1), min(2 * iterations, players - players % 2))
+    pairs = list(zip(pair_ids[::2], pair_ids[1::2]))
+    results = {}
+    phases = [
+        ('register', [command('register', players + 1 + i) for i in range(iterations)]),
+        ('rep', [command('rep', a, 'w', FakeMember(b)) for a, b in pairs]),
+        ('rep_confirm', [command('rep', b, 'l', FakeMember(a)) for a, b in pairs]),
+        ('stats', [command('stats', random_player()) for _ in range(iterations)]),
+        ('leaderboard', [command('leaderboard', random_player()) for _ in range(iterations)]),
+        ('stale_leaderboard', [command('stale_leaderboard', random_player()) for _ in range(iterations)]),
+    ]
+    for name, calls in phases:
+        if not calls:
+            continue
+        latencies, wall, error_count = await run_phase(ladder, calls, concurrency, errors, counter)
+        results[name] = summarize(latencies, wall, error_count, counter)
+        logging.warning(f"{name}: {results[name]['throughput_per_s']:.0f}/s, "
+                        f"p50 {results[name]['latency_ms']['p50']:.2f} ms, p99 {results[name]['latency_ms']['p99']:.2f} ms, "
+                        f"{results[name]['queries_per_call']:.1f} queries/call")
+
+    ladder.db.set_trace(None)
+    logging.getLogger().removeHandler(errors)
+    setup['leaderboard_cache_hits'] = ladder.leaderboard_cache.hits
+    setup['leaderboard_cache_misses'] = ladder.leaderboard_cache.misses
+    return setup, results
+
+
+def compare(results, baseline):
+    for name, result in results.items():
+        old = baseline.get('commands', {}).get(name)
+        if old is None:
+            continue
+        print(f"{name:18} throughput {result['throughput_per_s'] / old['throughput_per_s']:6.2f}x   "
+              f"p99 {old['latency_ms']['p99']:8.2f} -> {result['latency_ms']['p99']:8.2f} ms   "
+              f"queries/call {old['queries_per_call']:5.1f} -> {result['queries_per_call']:5.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the command handlers offline against a synthetic ladder.')
+    parser.add_argument('--players', type=int, default=10000)
+    parser.add_argument('--matches', type=int, default=50000, help='historic matches to seed')
+    parser.add_argument('--iterations', type=int, default=1000, help='calls per command')
+    parser.add_argument('--concurrency', type=int, default=8, help='calls in flight at once')
+    parser.add_argument('--rating-period-hours', type=float, default=None,
+                        help='run with rating periods of this length instead of instant rating')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    rnd = random.Random(args.seed)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo)
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # The bot opens players.db relative to the working directory
+        os.chdir(workdir)
+        started = time.perf_counter()
+        seed('players.db', args.players, args.matches, rnd)
+        seed_seconds = time.perf_counter() - started
+
+        bot_module = importlib.import_module('main')
+        logging.getLogger().setLevel(logging.WARNING)
+        if args.rating_period_hours:
+            bot_module.LADDERS[0].rating_period = timedelta(hours=args.rating_period_hours)
+        try:
+            setup, results = asyncio.run(benchmark(bot_module, args.players, args.iterations, args.concurrency, rnd))
+        finally:
+            for ladder in bot_module.LADDERS:
+                ladder.close()
+            os.chdir(repo)
+
+    setup['seed_s'] = seed_seconds
+    report = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'players': args.players,
+            'matches': args.matches,
+            'iterations': args.iterations,
+            'concurrency': args.concurrency,
+            'rating_period_hours': args.rating_period_hours,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'setup': setup,
+        'commands': results,
+    }
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'Results saved to {output}')
+    if baseline:
+        with open(baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
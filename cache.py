@@ -0,0 +1,61 @@
+import asyncio
+from collections import OrderedDict
+
+
+class VersionedCache:
+    """Caches one computed value per key, valid for a single version of its source.
+
+    A lookup with a newer version recomputes the value. Concurrent lookups of
+    the same key and version share one in-flight computation (single-flight).
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (version, value)
+        self._in_flight = {}  # (key, version) -> future
+
+    async def get(self, key, version, compute):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        flight = self._in_flight.get((key, version))
+        if flight is not None:
+            self.hits += 1
+            return await asyncio.shield(flight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[(key, version)] = future
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting on it; don't warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[(key, version)]
+
+        future.set_result(value)
+        current = self._entries.get(key)
+        # A slower computation of an older version mustn't replace a newer one
+        if current is None or current[0] <= version:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
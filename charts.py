@@ -0,0 +1,55 @@
+import importlib.util
+import io
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+# Rating charts for $history. render_png runs in a worker process; matplotlib is
+# optional, without it the bot answers with a text sparkline instead.
+
+SPARKS = '▁▂▃▄▅▆▇█'
+
+
+def available():
+    return importlib.util.find_spec('matplotlib') is not None
+
+
+def downsample(times, ratings, max_points=400):
+    """At most about max_points of the series, evenly spaced, always keeping the first, last, peak and low."""
+    if len(ratings) <= max_points:
+        return times, ratings
+    ratings = np.asarray(ratings)
+    keep = np.unique(np.concatenate([
+        np.linspace(0, len(ratings) - 1, max_points).round().astype(int),
+        [np.argmax(ratings), np.argmin(ratings)]]))
+    return [times[i] for i in keep], ratings[keep].tolist()
+
+
+def sparkline(ratings, width=40):
+    _, ratings = downsample(list(range(len(ratings))), ratings, width)
+    low, high = min(ratings), max(ratings)
+    if high == low:
+        return SPARKS[len(SPARKS) // 2] * len(ratings)
+    return ''.join(SPARKS[int((rating - low) / (high - low) * (len(SPARKS) - 1))] for rating in ratings)
+
+
+def render_png(times, ratings, title):
+    """PNG bytes of a rating-over-time line chart; times are unix epochs."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots(figsize=(8, 4), dpi=100)
+    try:
+        axes.plot([datetime.fromtimestamp(t, timezone.utc) for t in times], ratings, linewidth=1.5)
+        axes.set_title(title)
+        axes.set_ylabel('Rating')
+        axes.grid(alpha=0.3)
+        figure.autofmt_xdate()
+        figure.tight_layout()
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        plt.close(figure)
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _resolve(future, result, error):
+    # Runs on the event loop; the awaiting command may have been cancelled meanwhile
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class Database:
+    """Async front end for a SQLite file.
+
+    All writes go through one writer thread with its own connection, so they are
+    serialized without ever blocking the event loop. Writes that arrive close
+    together are group-committed in a single transaction. Reads run on a small
+    pool of threads, each with its own connection; WAL journaling lets them
+    proceed while the writer is committing.
+
+    An observer, if set, is called on the event loop as observer(kind, name,
+    seconds, failed) after every read ('read') and write ('write'); name is the
+    SQL for the helpers that take it and the function's qualified name otherwise.
+    """
+
+    def __init__(self, path, setup=None, readers=4, group_commit_window=0.002, max_batch=256, observer=None):
+        self.path = path
+        self.observer = observer
+        self.group_commit_window = group_commit_window
+        self.max_batch = max_batch
+        self._trace = None
+        self._read_conns = []
+        self._read_lock = threading.Lock()
+        self._write_conn = self._connect()
+        self._write_conn.execute('PRAGMA journal_mode = WAL')
+        self._write_conn.execute('PRAGMA synchronous = FULL')
+        if setup is not None:
+            # e.g. schema migrations, applied before any other connection exists
+            setup(self._write_conn)
+
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='db-writer', daemon=True)
+        self._writer.start()
+
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._closed = False
+
+    def _connect(self):
+        # isolation_level=None: transactions are opened explicitly by the writer thread
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA busy_timeout = 5000')
+        conn.set_trace_callback(self._trace)
+        return conn
+
+    def set_trace(self, callback):
+        """Call callback(sql) for every statement run on any connection; None turns it off.
+
+        The callback runs on the database threads, so it must be thread safe.
+        """
+        self._trace = callback
+        with self._read_lock:
+            conns = [self._write_conn, *self._read_conns]
+        for conn in conns:
+            conn.set_trace_callback(callback)
+
+    # Reads
+
+    def _read_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._read_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def _read(self, fn):
+        return fn(self._read_conn())
+
+    async def read(self, fn, name=None):
+        """Run fn(connection) on a reader thread and return its result."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await loop.run_in_executor(self._readers, self._read, fn)
+            failed = False
+            return result
+        finally:
+            if self.observer is not None:
+                self.observer('read', name or fn.__qualname__, time.perf_counter() - started, failed)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone(), sql)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall(), sql)
+
+    # Writes
+
+    def _next_batch(self):
+        # Block for the first job, then gather whatever arrives within the group
+        # commit window so the whole batch shares one COMMIT (and one fsync)
+        batch = [self._writes.get()]
+        deadline = time.monotonic() + self.group_commit_window
+        while batch[-1] is not None and len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._writes.get(timeout=remaining))
+                else:
+                    batch.append(self._writes.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        conn = self._write_conn
+        running = True
+        while running:
+            batch = self._next_batch()
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            if not batch:
+                continue
+
+            results = []
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for fn, future, loop in batch:
+                    # Each job gets a savepoint so one failing job doesn't undo the others
+                    conn.execute('SAVEPOINT job')
+                    try:
+                        results.append((fn(conn), None))
+                        conn.execute('RELEASE job')
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO job')
+                        conn.execute('RELEASE job')
+                        results.append((None, e))
+                conn.execute('COMMIT')
+            except Exception as e:
+                logging.error(f"Error committing write batch: {e}")
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                results = [(None, e)] * len(batch)
+
+            for (fn, future, loop), (result, error) in zip(batch, results):
+                try:
+                    loop.call_soon_threadsafe(_resolve, future, result, error)
+                except RuntimeError:
+                    # The loop that queued the write has shut down; nobody is waiting for it
+                    pass
+        conn.close()
+
+    def submit(self, fn, name=None):
+        """Queue fn(connection) for the writer thread and return a future for its result.
+
+        Writes run in submission order, so a caller that doesn't need to wait
+        can submit and move on without racing its own later writes.
+        """
+        if self._closed:
+            raise sqlite3.ProgrammingError('Database is closed')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if self.observer is not None:
+            started = time.perf_counter()
+            future.add_done_callback(lambda done: self.observer(
+                'write', name or fn.__qualname__, time.perf_counter() - started,
+                done.cancelled() or done.exception() is not None))
+        self._writes.put((fn, future, loop))
+        return future
+
+    async def transaction(self, fn, name=None):
+        """Run fn(connection) on the writer thread inside one transaction.
+
+        The changes are committed if fn returns and rolled back if it raises.
+        Jobs submitted within group_commit_window of each other share a commit.
+        """
+        return await self.submit(fn, name)
+
+    async def execute(self, sql, params=()):
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount, sql)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.transaction(lambda conn: conn.executemany(sql, seq_of_params).rowcount, sql)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Let queued writes finish before the writer connection goes away
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        with self._read_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+        logging.info('Database closed.')
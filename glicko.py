@@ -0,0 +1,129 @@
+import numpy as np
+
+
+# Vectorized Glicko-2, numerically equivalent to glicko2.Player (Ryan Kirkman's
+# implementation) but operating on whole columns of players at once.
+
+SCALE = 173.7178
+TAU = 0.5
+EPSILON = 0.000001
+
+
+def _g(phi):
+    return 1 / np.sqrt(1 + 3 * phi ** 2 / np.pi ** 2)
+
+
+def _new_vol(mu, phi, vol, delta, v):
+    # Illinois iteration for the new volatility (step 5 of the Feb 2012 paper),
+    # run for every player until each of them converges.
+    a = np.log(vol ** 2)
+
+    def f(x, i):
+        # glicko2.Player uses the rating (mu) here where the paper has phi;
+        # kept as is so ratings don't shift when switching engines
+        ex = np.exp(x)
+        return ex * (delta[i] ** 2 - mu[i] ** 2 - v[i] - ex) / (2 * (mu[i] ** 2 + v[i] + ex) ** 2) - (x - a[i]) / TAU ** 2
+
+    everyone = np.arange(len(mu))
+    A = a.copy()
+    B = np.empty_like(a)
+    big = delta ** 2 > phi ** 2 + v
+    B[big] = np.log(delta[big] ** 2 - phi[big] ** 2 - v[big])
+
+    small = np.flatnonzero(~big)
+    k = np.ones(len(small))
+    searching = np.arange(len(small))
+    while len(searching):
+        below = f(a[small[searching]] - k[searching] * TAU, small[searching]) < 0
+        searching = searching[below]
+        k[searching] += 1
+    B[small] = a[small] - k * TAU
+
+    fA = f(A, everyone)
+    fB = f(B, everyone)
+    active = np.flatnonzero(np.abs(B - A) > EPSILON)
+    while len(active):
+        C = A[active] + (A[active] - B[active]) * fA[active] / (fB[active] - fA[active])
+        fC = f(C, active)
+        swap = fC * fB[active] <= 0
+        A[active[swap]] = B[active[swap]]
+        fA[active[swap]] = fB[active[swap]]
+        fA[active[~swap]] /= 2
+        B[active] = C
+        fB[active] = fC
+        active = active[np.abs(B[active] - A[active]) > EPSILON]
+
+    return np.exp(A / 2)
+
+
+def rate_period(rating, rd, vol, game_player, game_opp_rating, game_opp_rd, game_score):
+    """Rate one rating period for every player in the rating/rd/vol columns.
+
+    Games are given as parallel arrays: game_player is the row of the rated
+    player, and the other three hold the opponent's pre-period rating and rd
+    and the score (1, 0.5 or 0). A two-player game therefore appears twice,
+    once from each side. Players without games only have their rd grown, as
+    glicko2.Player.did_not_compete does.
+
+    Returns new (rating, rd, vol) arrays.
+    """
+    rating = np.asarray(rating, dtype=float)
+    mu = (rating - 1500) / SCALE
+    phi = np.asarray(rd, dtype=float) / SCALE
+    vol = np.asarray(vol, dtype=float)
+    game_player = np.asarray(game_player, dtype=np.intp)
+    opp_mu = (np.asarray(game_opp_rating, dtype=float) - 1500) / SCALE
+    opp_phi = np.asarray(game_opp_rd, dtype=float) / SCALE
+    score = np.asarray(game_score, dtype=float)
+
+    g = _g(opp_phi)
+    E = 1 / (1 + np.exp(-g * (mu[game_player] - opp_mu)))
+    count = len(mu)
+    played = np.bincount(game_player, minlength=count) > 0
+    v_inverse = np.bincount(game_player, weights=g ** 2 * E * (1 - E), minlength=count)
+    improvement = np.bincount(game_player, weights=g * (score - E), minlength=count)
+
+    new_mu = mu.copy()
+    new_phi = np.sqrt(phi ** 2 + vol ** 2)
+    new_vol = vol.copy()
+
+    p = np.flatnonzero(played)
+    if len(p):
+        v = 1 / v_inverse[p]
+        new_vol[p] = _new_vol(mu[p], phi[p], vol[p], v * improvement[p], v)
+        phi_star = np.sqrt(phi[p] ** 2 + new_vol[p] ** 2)
+        new_phi[p] = 1 / np.sqrt(1 / phi_star ** 2 + 1 / v)
+        new_mu[p] = mu[p] + new_phi[p] ** 2 * improvement[p]
+
+    return new_mu * SCALE + 1500, new_phi * SCALE, new_vol
+
+
+def rate_games(rating_a, rd_a, vol_a, rating_b, rd_b, vol_b, score_a):
+    """Rate many independent games, each its own rating period for both players.
+
+    Every argument is a column with one entry per game; a player may appear in
+    at most one of them. Returns ((rating, rd, vol) of side a, same for side b).
+    """
+    rating_a, rating_b = np.atleast_1d(rating_a), np.atleast_1d(rating_b)
+    rd_a, rd_b = np.atleast_1d(rd_a), np.atleast_1d(rd_b)
+    score_a = np.atleast_1d(np.asarray(score_a, dtype=float))
+    games = len(rating_a)
+    rating, rd, vol = rate_period(
+        np.concatenate([rating_a, rating_b]),
+        np.concatenate([rd_a, rd_b]),
+        np.concatenate([np.atleast_1d(vol_a), np.atleast_1d(vol_b)]),
+        np.arange(2 * games),
+        np.concatenate([rating_b, rating_a]),
+        np.concatenate([rd_b, rd_a]),
+        np.concatenate([score_a, 1 - score_a]))
+    return ((rating[:games], rd[:games], vol[:games]),
+            (rating[games:], rd[games:], vol[games:]))
+
+
+def inflate_rd(rd, vol, periods, max_rd):
+    """RD after sitting out `periods` rating periods, capped at max_rd.
+
+    Same as calling glicko2.Player.did_not_compete once per period, in O(1).
+    """
+    periods = np.maximum(periods, 0)
+    return np.minimum(np.sqrt((np.asarray(rd) / SCALE) ** 2 + periods * np.asarray(vol) ** 2) * SCALE, max_rd)
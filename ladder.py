@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from datetime import timedelta
+
+import glicko
+from backup import replace_database
+from cache import VersionedCache
+from database import Database
+from matchmaking import MatchQueue
+from migrations import migrate
+from names import NameCache
+from pending import PendingReports
+from players import PlayerStore, scan_players, write_snapshot
+from periods import PeriodBuffer, elapsed_periods
+from ranking import RankIndex
+from writebehind import WriteBehind
+
+
+class Ladder:
+    """One rating ladder: the channel it is played in, its Glicko-2 settings and its state.
+
+    Every ladder keeps its players in its own SQLite file, served by its own
+    writer thread and readers, so ladders never wait on each other's locks or
+    commits. Settings are plain attributes; open() creates the database and
+    the in-memory indexes.
+    """
+
+    def __init__(self, name, channel_id, path, int_rating=1400, int_rd=350, int_vol=0.06, rd_cutoff=250,
+                 rating_period=None, rd_decay_period=timedelta(days=1), min_matches=4,
+                 active_window=timedelta(days=90), pending_lifetime=timedelta(minutes=20), pending_journal=True,
+                 write_behind=False, write_behind_delay=1.0, queue_timeout=timedelta(minutes=15),
+                 backup_interval=timedelta(hours=6), backups_kept=8, backup_dir='backups'):
+        self.name = name
+        self.channel_id = channel_id
+        self.path = path
+        self.int_rating = int_rating
+        self.int_rd = int_rd
+        self.int_vol = int_vol
+        self.rd_cutoff = rd_cutoff
+        # None rates every game on its own as soon as it is confirmed; e.g. timedelta(days=1)
+        # collects a day of games and rates them together
+        self.rating_period = rating_period
+        # Without rating periods, how long a player has to be inactive for their RD to grow by one step
+        self.rd_decay_period = rd_decay_period
+        self.min_matches = min_matches
+        self.active_window = active_window
+        self.pending_lifetime = pending_lifetime
+        # False keeps pending reports in memory only; they are then lost on restart
+        self.pending_journal = pending_journal
+        # True lets $rep and $cancel reply before their journal write is committed; the writes are
+        # batched for up to write_behind_delay seconds, with a crash journal next to the database
+        self.write_behind = write_behind
+        self.write_behind_delay = write_behind_delay
+        # How long $looking keeps a player queued without finding an opponent
+        self.queue_timeout = queue_timeout
+        # Compressed online backups of the database, the newest backups_kept of them; None turns them off
+        self.backup_interval = backup_interval
+        self.backups_kept = backups_kept
+        self.backup_dir = backup_dir
+        # Held while a backup or restore runs
+        self.backup_lock = asyncio.Lock()
+        # Memory-mapped copy of the players table, read at startup instead of scanning it
+        self.snapshot_path = f'{path}.players'
+        self.db = None
+        self.writes = None
+        self.close_task = None
+        self.backup_task = None
+
+    def open(self, bot, observer=None, readers=2):
+        self.open_storage(observer, readers)
+        self.open_state(bot)
+        return self
+
+    def open_storage(self, observer=None, readers=2):
+        # The blocking half of open(): migrations, threads and loading the players; safe off the event loop
+        self.db = Database(self.path, setup=migrate, readers=readers, observer=observer)
+        # Every player's rating and record; commands read these instead of the database
+        self.players = PlayerStore()
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            warm = self.players.load(conn, self.snapshot_path)
+        finally:
+            conn.close()
+        logging.info(f'{self.name}: loaded {len(self.players)} players from the {"snapshot" if warm else "database"}.')
+        # Ratings of every placed player, kept sorted in memory for the leaderboards
+        self.rank_index = RankIndex(self.min_matches, self.active_window)
+        if self.write_behind and self.pending_journal:
+            # Replays whatever a crash left in the journal before anything reads the database
+            self.writes = WriteBehind(self.db, f'{self.path}.writes', max_delay=self.write_behind_delay)
+
+    def open_state(self, bot):
+        # The asyncio half of open(), run on the event loop
+        self.rank_index_lock = asyncio.Lock()
+        # Reports waiting for the opponent's confirmation
+        self.pending_reports = PendingReports(self.pending_lifetime, journal=self.db if self.pending_journal else None,
+                                              write_behind=self.writes)
+        # Games of the open rating period, for showing provisional ratings
+        self.period_buffer = PeriodBuffer()
+        # Display names for leaderboard rows, so rendering rarely has to wait on the Discord API
+        self.name_cache = NameCache(bot, self.db)
+        # Players looking for a game, paired by rating
+        self.match_queue = MatchQueue(timeout=self.queue_timeout.total_seconds())
+        # Rendered top 10 of each leaderboard, recomputed only when those places change
+        self.leaderboard_cache = VersionedCache()
+        # Rendered $history charts, until the player's rating next changes
+        self.chart_cache = VersionedCache(max_size=128)
+
+    def decay_period(self):
+        return self.rating_period or self.rd_decay_period
+
+    def effective_rd(self, rd, vol, rd_updated, now):
+        # The stored rd is as of rd_updated; it grows by one step for every rating period since
+        return float(glicko.inflate_rd(rd, vol, elapsed_periods(rd_updated, now, self.decay_period()), self.int_rd))
+
+    def close(self):
+        if self.close_task is not None:
+            self.close_task.cancel()
+        self.close_storage()
+
+    def close_storage(self):
+        if self.db is not None:
+            self.db.close()
+            if self.writes is not None:
+                self.writes.close()
+            self.save_snapshot()
+
+    async def restore(self, restore_path, bot, observer=None):
+        """Close, swap in the verified database prepared at restore_path and open it again.
+
+        Closing, the swap and reopening all block, so they run on a worker
+        thread; only the asyncio state is recreated on the event loop.
+        """
+        if self.close_task is not None:
+            self.close_task.cancel()
+            self.close_task = None
+        if self.writes is not None:
+            # Cancels its flush timer here, on the loop it was scheduled on
+            self.writes.flush()
+        await asyncio.get_running_loop().run_in_executor(None, self._swap_database, restore_path, observer)
+        self.open_state(bot)
+        return self
+
+    def _swap_database(self, restore_path, observer):
+        self.close_storage()
+        replace_database(self.path, restore_path)
+        # Its players_version counts another history's changes
+        if os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        self.open_storage(observer)
+
+    def save_snapshot(self):
+        # From the database rather than from memory, so it can't record a write that didn't commit
+        try:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            try:
+                version, columns = scan_players(conn)
+            finally:
+                conn.close()
+            write_snapshot(self.snapshot_path, version, columns)
+        except Exception as e:
+            logging.error(f"Error saving player snapshot: {e}")
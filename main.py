@@ -1,231 +1,356 @@
+import asyncio
+import io
 import glicko2
 import discord
 from discord.ext import commands, tasks
 from glicko2 import Player
-import sqlite3
 import logging
-from datetime import datetime, timedelta
-
-
-int_rating = 1400
-int_rd = 350
-int_vol = 0.06
-rd_cutoff = 250
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import charts
+from backup import list_backups, prepare_restore, take_backup
+import glicko
+from ladder import Ladder
+from matchmaking import QueueEntry
+from metrics import Metrics, resident_memory
+from pending import delete_journaled
+from periods import SCORES, close_period, from_epoch, to_epoch
+from players import PlayerRow, scan_players
+from profiling import CommandProfiler
+from recompute import recompute
+from rounds import apply_round, parse_round
+from transfer import InvalidRow
+
+
+# Every ladder the bot runs, one per channel, each with its own database file and rating
+# settings (see ladder.py), e.g.
+#   Ladder('Blitz', channel_id=..., path='blitz.db', int_rating=1500, rating_period=timedelta(days=1))
+LADDERS = [
+    Ladder('5D Chess', channel_id=1257478537263317073, path='players.db'),  # Replace with your channel ID
+]
+
+# Worker processes drawing the $history charts, started on first use
+chart_workers = 2
+chart_pool = None
+
+# Members with this role may submit tournament rounds with $round, besides administrators
+organizer_role = 'Organizer'
+
+# Where $profile dump writes the profiles of the sampled commands
+profile_dir = 'profiles'
+
+# Set to True to split the gateway connection into the shards Discord recommends;
+# required once the bot is in 2500 guilds
+sharded = False
+
+# Set to a port, e.g. 9108, to serve Prometheus metrics on http://127.0.0.1:<port>/metrics
+metrics_port = None
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='$', intents=intents)
-
-# Connect to SQLite database
-conn = sqlite3.connect('players.db')
-c = conn.cursor()
-
-# Create players table if it doesn't exist
-c.execute('''CREATE TABLE IF NOT EXISTS players
-             (discord_id INTEGER PRIMARY KEY, rating REAL, rd REAL, vol REAL, last_match TEXT, matches_played INTEGER, wins INTEGER, losses INTEGER, draws INTEGER)''')
-conn.commit()
-
-# Create pending_matches table if it doesn't exist
-c.execute('''CREATE TABLE IF NOT EXISTS pending_matches
-             (reporter_id INTEGER, opponent_id INTEGER, result TEXT, timestamp TEXT)''')
-conn.commit()
-
-# Set the ID of the channel where the bot should respond
-ALLOWED_CHANNEL_ID = 1257478537263317073  # Replace with your channel ID
-
-def is_allowed_channel(ctx):
-    return ctx.channel.id == ALLOWED_CHANNEL_ID
-
-def player_exists(discord_id):
-    c.execute('SELECT * FROM players WHERE discord_id = ?', (discord_id,))
-    return c.fetchone() is not None
-
-def create_player(discord_id):
+# Command and query latencies, event loop lag and error counts; see $metrics
+metrics = Metrics()
+
+# Samples commands with cProfile and tracemalloc once turned on with $profile
+profiler = CommandProfiler()
+
+# Only what the commands use: guilds and channels, and the text of messages for the $ prefix.
+# Members arrive with the messages that mention them, so the bot needs neither the members
+# intent nor a member cache, and doesn't download every guild's member list at startup.
+intents = discord.Intents.none()
+intents.guilds = True
+intents.guild_messages = True
+intents.message_content = True
+bot_options = dict(command_prefix='$', intents=intents, member_cache_flags=discord.MemberCacheFlags.none(),
+                   chunk_guilds_at_startup=False, max_messages=None)
+bot = commands.AutoShardedBot(**bot_options) if sharded else commands.Bot(**bot_options)
+
+# Open every ladder's database; every query runs off the event loop. Not in the chart
+# workers, which import this module again as __mp_main__ when they start
+if __name__ != '__mp_main__':
+    for ladder in LADDERS:
+        ladder.open(bot, observer=metrics.observe_query)
+ladders = {ladder.channel_id: ladder for ladder in LADDERS}
+
+def ladder_total(value):
+    return lambda: sum(value(ladder) for ladder in LADDERS)
+
+metrics.gauge('leaderboard_cache_hits_total', 'Leaderboard renders served from the cache.', ladder_total(lambda l: l.leaderboard_cache.hits), 'counter')
+metrics.gauge('leaderboard_cache_misses_total', 'Leaderboard renders computed.', ladder_total(lambda l: l.leaderboard_cache.misses), 'counter')
+metrics.gauge('name_cache_hits_total', 'Names resolved from memory.', ladder_total(lambda l: l.name_cache.hits), 'counter')
+metrics.gauge('name_cache_db_hits_total', 'Names resolved from the usernames table.', ladder_total(lambda l: l.name_cache.db_hits), 'counter')
+metrics.gauge('name_cache_fetches_total', 'Names requested from the Discord API.', ladder_total(lambda l: l.name_cache.fetches), 'counter')
+metrics.gauge('placed_players', 'Players on the all time leaderboards.', ladder_total(lambda l: len(l.rank_index.all_time)))
+metrics.gauge('active_players', 'Players on the active leaderboards.', ladder_total(lambda l: len(l.rank_index.active)))
+metrics.gauge('pending_reports', 'Match reports awaiting confirmation.', ladder_total(lambda l: len(l.pending_reports)))
+metrics.gauge('queued_writes', 'Writes waiting in the write-behind queues.', ladder_total(lambda l: len(l.writes) if l.writes else 0))
+metrics.gauge('queued_players', 'Players in the matchmaking queues.', ladder_total(lambda l: len(l.match_queue)))
+if resident_memory() is not None:
+    metrics.gauge('resident_memory_bytes', 'Memory the process has resident.', resident_memory)
+metrics.gauge('open_period_matches', 'Matches waiting for the rating period to close.', ladder_total(lambda l: len(l.period_buffer)))
+
+def get_ladder(ctx):
+    # The ladder played in the command's channel; the bot ignores every other channel
+    return ladders.get(ctx.channel.id)
+
+def player_exists(ladder, discord_id):
+    return discord_id in ladder.players
+
+async def create_player(ladder, discord_id):
     try:
-        if player_exists(discord_id):
+        # Initialize the player with the ladder's starting rating, rd and vol
+        player = Player(rating=ladder.int_rating, rd=ladder.int_rd, vol=ladder.int_vol)
+        now = datetime.utcnow()
+        inserted = await ladder.db.execute(
+            'INSERT OR IGNORE INTO players (discord_id, rating, rd, vol, last_match, matches_played, wins, losses, draws, rd_updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (discord_id, player.rating, player.rd, player.vol, to_epoch(now), 0, 0, 0, 0, to_epoch(now)))
+        if inserted != 1:
             return False
-        # Initialize the player with rating 1400, rd 350, and vol 0.06
-        player = Player(rating=int_rating, rd=int_rd, vol=int_vol)
-        now = datetime.utcnow().isoformat()
-        c.execute(
-            'INSERT INTO players (discord_id, rating, rd, vol, last_match, matches_played, wins, losses, draws) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            (discord_id, player.rating, player.rd, player.vol, now, 0, 0, 0, 0))
-        conn.commit()
+        ladder.players.put(PlayerRow(discord_id, player.rating, player.rd, player.vol, to_epoch(now), to_epoch(now), 0, 0, 0, 0))
+        ladder.rank_index.update(discord_id, player.rating, 0, now)
         return True
     except Exception as e:
         logging.error(f"Error creating player: {e}")
         return False
 
-def get_player(discord_id):
-    try:
-        c.execute('SELECT * FROM players WHERE discord_id = ?', (discord_id,))
-        player_data = c.fetchone()
-        if player_data:
-            return Player(player_data[1], player_data[2], player_data[3])
-        return None
-    except Exception as e:
-        logging.error(f"Error getting player: {e}")
-        return None
-
-def get_fetch_user(bot, user_id):
-    user = bot.get_user(user_id)
-    if not user:  # the user isn't in the cache, or it doesn't exist
-        try:
-            user = bot.fetch_user(user_id)
-        except discord.NotFound:  # fetch_user raises an error if the user doesn't exist
-            user = None
-    return user
-
-def update_glicko(discord_id, rating, rd, vol):
-    try:
-        c.execute('UPDATE players SET rating = ?, rd = ?, vol = ? WHERE discord_id = ?',
-                  (rating, rd, vol, discord_id))
-        conn.commit()
-    except Exception as e:
-        logging.error(f"Error updating Glicko scores: {e}")
-
-def update_player_stats(discord_id, player, win=False, loss=False, draw=False):
-    try:
-        now = datetime.utcnow().isoformat()
-        c.execute(
-            'UPDATE players SET rating = ?, rd = ?, vol = ?, last_match = ?, matches_played = matches_played + 1 WHERE discord_id = ?',
-            (player.rating, player.rd, player.vol, now, discord_id))
-        if win:
-            c.execute('UPDATE players SET wins = wins + 1 WHERE discord_id = ?', (discord_id,))
-        if loss:
-            c.execute('UPDATE players SET losses = losses + 1 WHERE discord_id = ?', (discord_id,))
-        if draw:
-            c.execute('UPDATE players SET draws = draws + 1 WHERE discord_id = ?', (discord_id,))
-        conn.commit()
-    except Exception as e:
-        logging.error(f"Error updating player: {e}")
-
-def report_pending_match(reporter_id, opponent_id, result):
-    try:
-        now = datetime.utcnow().isoformat()
-        c.execute('INSERT INTO pending_matches (reporter_id, opponent_id, result, timestamp) VALUES (?, ?, ?, ?)',
-                  (reporter_id, opponent_id, result, now))
-        conn.commit()
-    except Exception as e:
-        logging.error(f"Error reporting pending match: {e}")
-
-def get_pending_match(reporter_id, opponent_id, timestamp):
-    try:
-        c.execute(
-            'SELECT * FROM pending_matches WHERE reporter_id = ? AND opponent_id = ? AND timestamp = ?',
-            (reporter_id, opponent_id, timestamp))
-        return c.fetchone()
-    except Exception as e:
-        logging.error(f"Error getting pending match: {e}")
-        return None
-
-def get_pending_matches(reporter_id, opponent_id):
-    try:
-        c.execute(
-            'SELECT * FROM pending_matches WHERE (reporter_id = ? AND opponent_id = ?) OR (reporter_id = ? AND opponent_id = ?)',
-            (reporter_id, opponent_id, opponent_id, reporter_id))
-        return c.fetchall()
-    except Exception as e:
-        logging.error(f"Error getting pending matches: {e}")
-        return []
-
-def delete_pending_match(reporter_id, opponent_id, timestamp):
-    try:
-        c.execute(
-            'DELETE FROM pending_matches WHERE reporter_id = ? AND opponent_id = ? AND timestamp = ?',
-            (reporter_id, opponent_id, timestamp))
-        conn.commit()
-    except Exception as e:
-        logging.error(f"Error deleting pending match: {e}")
-
-def finalize_match(reporter_id, opponent_id, result, timestamp):
-    try:
-        reporter_player = get_player(reporter_id)
-        opponent_player = get_player(opponent_id)
-
-        if result == 'd':
-
-            r_rd = reporter_player.rd
-            r_rating = reporter_player.rating
-
-            o_rd = opponent_player.rd
-            o_rating = opponent_player.rating
-
-            reporter_player.update_player([o_rating], [o_rd], [0.5])
-            opponent_player.update_player([r_rating], [r_rd], [0.5])
-
-            update_player_stats(reporter_id, reporter_player, draw=True)
-            update_player_stats(opponent_id, opponent_player, draw=True)
-
-            update_glicko(reporter_id, reporter_player.rating, reporter_player.rd, reporter_player.vol)
-            update_glicko(opponent_id, opponent_player.rating, opponent_player.rd, opponent_player.vol)
-
+async def finalize_match(ladder, reporter_id, opponent_id, result, reports=()):
+    # Rates the game (or adds it to the open rating period), records it in the match history,
+    # updates both players and deletes the consumed reports' journal rows in one transaction.
+    # Returns the shown (rating, wins, losses, draws, rd, matches_played) of reporter and opponent.
+    def write(conn):
+        rows = {row[0]: row for row in conn.execute(
+            'SELECT discord_id, rating, rd, vol, wins, losses, draws, matches_played, rd_updated FROM players WHERE discord_id IN (?, ?)',
+            (reporter_id, opponent_id))}
+        now = to_epoch(datetime.utcnow())
+        # Both players with their RD grown up to now; it is stored again only when rated
+        reporter_data, opponent_data = (
+            (*data[:2], ladder.effective_rd(data[2], data[3], data[8], now), *data[3:])
+            for data in (rows[reporter_id], rows[opponent_id]))
+
+        score = SCORES[result]
+        if ladder.rating_period is None:
+            reporter_new, opponent_new = glicko.rate_games(
+                reporter_data[1], reporter_data[2], reporter_data[3],
+                opponent_data[1], opponent_data[2], opponent_data[3], score)
+            new_values = [tuple(float(column[0]) for column in new) for new in (reporter_new, opponent_new)]
+            after = (new_values[0][0], new_values[0][1], new_values[1][0], new_values[1][1])
+            stored = [(*values, now) for values in new_values]
         else:
-            if result == 'w':
-                winner_id = reporter_id
-                loser_id = opponent_id
-            else:
-                winner_id = opponent_id
-                loser_id = reporter_id
-
-            winner_player = get_player(winner_id)
-            loser_player = get_player(loser_id)
-
-            w_rating = winner_player.rating
-            w_rd = winner_player.rating
-
-            l_rating = loser_player.rating
-            l_rd = loser_player.rd
-
-            winner_player.update_player([l_rating], [l_rd], [1])
-            loser_player.update_player([w_rating], [w_rd],[0])
-
-            update_player_stats(winner_id, winner_player, win=True)
-            update_player_stats(loser_id, loser_player, loss=True)
-
-            update_glicko(winner_id, winner_player.rating, winner_player.rd, winner_player.vol)
-            update_glicko(loser_id, loser_player.rating, loser_player.rd, loser_player.vol)
-
+            # Ratings stay put until the period closes
+            new_values = [(data[1], data[2], data[3]) for data in (reporter_data, opponent_data)]
+            after = (None, None, None, None)
+            stored = [(*rows[data[0]][1:4], rows[data[0]][8]) for data in (reporter_data, opponent_data)]
+
+        match_id = conn.execute(
+            'INSERT INTO matches (reporter_id, opponent_id, result, played_at, rated, '
+            'reporter_rating_before, reporter_rd_before, reporter_rating_after, reporter_rd_after, '
+            'opponent_rating_before, opponent_rd_before, opponent_rating_after, opponent_rd_after) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (reporter_id, opponent_id, result, now, int(ladder.rating_period is None),
+             reporter_data[1], reporter_data[2], after[0], after[1],
+             opponent_data[1], opponent_data[2], after[2], after[3])).lastrowid
+
+        for data, (rating, rd, vol, rd_updated), s in zip((reporter_data, opponent_data), stored, (score, 1 - score)):
+            conn.execute(
+                'UPDATE players SET rating = ?, rd = ?, vol = ?, rd_updated = ?, last_match = ?, matches_played = matches_played + 1, '
+                'wins = wins + ?, losses = losses + ?, draws = draws + ? WHERE discord_id = ?',
+                (rating, rd, vol, rd_updated, now, int(s == 1), int(s == 0), int(s == 0.5), data[0]))
+
+        if ladder.pending_reports.journal is not None:
+            for report in reports:
+                delete_journaled(conn, report)
+        return reporter_data, opponent_data, new_values, stored, match_id, now
+
+    if ladder.writes is not None:
+        # The queued journal writes must land before this deletes the consumed reports' rows
+        ladder.writes.flush()
+    try:
+        reporter_data, opponent_data, new_values, stored, match_id, now = await ladder.db.transaction(write)
     except Exception as e:
         logging.error(f"Error finalizing match: {e}")
+        return None
 
-@tasks.loop(minutes=5)
-async def cleanup_pending_matches():
+    if ladder.rating_period is not None:
+        ladder.period_buffer.add(match_id, reporter_id, opponent_id, reporter_data[1:3], opponent_data[1:3], result)
+
+    last_match = from_epoch(now)
+    score = SCORES[result]
+    updated = []
+    for data, (rating, rd, vol), row, s in zip((reporter_data, opponent_data), new_values, stored, (score, 1 - score)):
+        ladder.players.put(PlayerRow(data[0], *row, now, data[4] + int(s == 1), data[5] + int(s == 0),
+                                     data[6] + int(s == 0.5), data[7] + 1))
+        ladder.rank_index.update(data[0], rating, data[7] + 1, last_match)
+        shown_rating, shown_rd, _ = ladder.period_buffer.provisional(data[0], rating, rd, vol)
+        updated.append((shown_rating, data[4] + int(s == 1), data[5] + int(s == 0), data[6] + int(s == 0.5),
+                        shown_rd, data[7] + 1))
+    return updated
+
+async def load_rank_index(ladder, reload=False):
+    rank_index = ladder.rank_index
+    async with ladder.rank_index_lock:
+        if reload:
+            rank_index.clear()
+            ladder.leaderboard_cache.invalidate()
+        if rank_index.loaded:
+            return
+        players = ladder.players
+        placed = players.column('matches_played') >= rank_index.min_matches
+        columns = [players.column(name)[placed].tolist() for name in ('discord_id', 'rating', 'matches_played', 'last_match')]
+        rank_index.load(((discord_id, rating, matches, from_epoch(last_match))
+                         for discord_id, rating, matches, last_match in zip(*columns)), datetime.utcnow())
+        logging.info(f'{ladder.name}: rank index loaded with {len(rank_index.all_time)} placed players.')
+
+async def close_rating_period(ladder):
     try:
-        expiration_time = datetime.utcnow() - timedelta(minutes=20)
-        c.execute('DELETE FROM pending_matches WHERE timestamp <= ?', (expiration_time.isoformat(),))
-        conn.commit()
-        logging.info('Cleanup: Removed pending matches older than 20 minutes.')
+        now = datetime.utcnow()
+        closed, updated = await ladder.db.transaction(lambda conn: close_period(conn, ladder.int_rd, ladder.rating_period, now))
+        ladder.period_buffer.remove(closed)
+        for discord_id, (rating, rd, vol) in updated.items():
+            ladder.players.update(discord_id, rating=rating, rd=rd, vol=vol, rd_updated=to_epoch(now))
+            ladder.rank_index.set_rating(discord_id, rating)
+        logging.info(f'{ladder.name}: closed rating period, rated {len(closed)} matches for {len(updated)} players.')
     except Exception as e:
-        logging.error(f"Error during cleanup of pending matches: {e}")
+        logging.error(f"Error closing rating period: {e}")
+
+def start_rating_periods(ladder):
+    @tasks.loop(seconds=ladder.rating_period.total_seconds())
+    async def close_periodically():
+        await close_rating_period(ladder)
+
+    @close_periodically.before_loop
+    async def wait_for_period_end():
+        # Periods run on from the last close (or the open period's first game), not from
+        # process start, so restarts don't push them back; an overdue one closes right away
+        started = await ladder.db.fetchone(
+            'SELECT COALESCE((SELECT MAX(closed_at) FROM rating_periods), '
+            '(SELECT MIN(played_at) FROM matches WHERE rated = 0))')
+        started = to_epoch(datetime.utcnow()) if started[0] is None else started[0]
+        due = started + ladder.rating_period.total_seconds()
+        await asyncio.sleep(max(0, due - to_epoch(datetime.utcnow())))
+
+    ladder.close_task = close_periodically
+    close_periodically.start()
+
+async def back_up(ladder):
+    # Returns (file, bytes); the copy runs on a worker thread in small steps
+    async with ladder.backup_lock:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, take_backup, ladder.path, ladder.backup_dir, ladder.backups_kept)
+
+def start_backups(ladder):
+    @tasks.loop(seconds=ladder.backup_interval.total_seconds())
+    async def back_up_periodically():
+        try:
+            backup, size = await back_up(ladder)
+            logging.info(f'{ladder.name}: backed up to {backup} ({size / 2**20:.1f} MB).')
+        except Exception as e:
+            logging.error(f"Error backing up {ladder.name}: {e}")
+
+    @back_up_periodically.before_loop
+    async def wait_for_backup_due():
+        # Backups run on from the newest one on disk, not from process start, so restarts
+        # don't push them back; with none, or an overdue one, a backup is taken right away
+        backups = await asyncio.get_running_loop().run_in_executor(None, list_backups, ladder.path, ladder.backup_dir)
+        if backups:
+            due = backups[-1][0] + ladder.backup_interval
+            await asyncio.sleep(max(0, (due - datetime.utcnow()).total_seconds()))
+
+    ladder.backup_task = back_up_periodically
+    back_up_periodically.start()
+
+async def load_period_buffer(ladder):
+    rows = await ladder.db.fetchall(
+        'SELECT id, reporter_id, opponent_id, result, reporter_rating_before, reporter_rd_before, '
+        'opponent_rating_before, opponent_rd_before FROM matches WHERE rated = 0 ORDER BY id')
+    ladder.period_buffer.load(rows)
+
+async def start_ladder(ladder):
+    await load_rank_index(ladder)
+    await ladder.pending_reports.load()
+    if ladder.rating_period is not None and ladder.close_task is None:
+        await load_period_buffer(ladder)
+        start_rating_periods(ladder)
+    if ladder.backup_interval is not None and ladder.backup_task is None:
+        start_backups(ladder)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.profile = profiler.start(ctx.command.qualified_name)
+    ctx.started = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    metrics.observe_command(ctx.command.qualified_name, time.perf_counter() - ctx.started, ctx.command_failed)
+    profiler.stop(ctx.profile)
+
+@bot.listen()
+async def on_command_error(ctx, error):
+    metrics.command_errors[type(error).__name__] += 1
+    if not isinstance(error, commands.CommandNotFound):
+        logging.error(f"Error in command {ctx.command}: {error}")
+
+@bot.listen()
+async def on_disconnect():
+    # Don't hold queued writes while the connection is down; the bot may not come back
+    for ladder in LADDERS:
+        if ladder.writes is not None:
+            ladder.writes.flush()
 
 @bot.event
 async def on_ready():
     logging.info(f'Logged in as {bot.user}')
-    cleanup_pending_matches.start()
+    await metrics.start(metrics_port)
+    # Ladders load independently of each other
+    await asyncio.gather(*(start_ladder(ladder) for ladder in LADDERS))
+    if not run_matchmaking.is_running():
+        run_matchmaking.start()
+        # on_ready fires again after reconnects; only the first one ends the startup
+        memory = resident_memory()
+        logging.info(f'Ready in {time.time() - metrics.started:.1f}s with {len(bot.guilds)} guilds on '
+                     f'{bot.shard_count or 1} shards' + (f', {memory / 2**20:.0f} MB resident.' if memory is not None else '.'))
 
 @bot.command()
 async def register(ctx):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
-    if player_exists(ctx.author.id):
+    if player_exists(ladder, ctx.author.id):
         embed = discord.Embed(description=f'{ctx.author.mention}, you are already registered.')
         await ctx.send(embed=embed)
         return
 
-    if create_player(ctx.author.id):
-        embed = discord.Embed(description=f'{ctx.author.mention}, you have been registered with a starting rating of 1400.')
+    if await create_player(ladder, ctx.author.id):
+        embed = discord.Embed(description=f'{ctx.author.mention}, you have been registered with a starting rating of {ladder.int_rating}.')
         await ctx.send(embed=embed)
     else:
         embed = discord.Embed(description=f'{ctx.author.mention}, there was an error registering you. Please try again.')
         await ctx.send(embed=embed)
 
+# The result the opponent has to report for a pending match to be confirmed
+COUNTERPARTS = {'w': 'l', 'l': 'w', 'd': 'd'}
+
+def format_player_stats(ladder, player_data, provisional=False):
+    # player_data is (rating, wins, losses, draws, rd)
+    added_marker = '?' if player_data[4] > ladder.rd_cutoff else ''
+    if provisional:
+        added_marker += ' (provisional)'
+    return (
+        f"Rating: {round(player_data[0],1)}{added_marker}\n"
+        f"Wins: {player_data[1]} | "
+        f"Losses: {player_data[2]} | "
+        f"Draws: {player_data[3]}"
+    )
+
 @bot.command()
 async def rep(ctx, result: str, opponent: discord.Member):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
     if result not in ['w', 'l', 'd']:
@@ -233,12 +358,12 @@ async def rep(ctx, result: str, opponent: discord.Member):
         await ctx.send(embed=embed)
         return
 
-    if not player_exists(ctx.author.id):
+    if not player_exists(ladder, ctx.author.id):
         embed = discord.Embed(description=f'{ctx.author.mention}, you need to register first using $register.')
         await ctx.send(embed=embed)
         return
 
-    if not player_exists(opponent.id):
+    if not player_exists(ladder, opponent.id):
         embed = discord.Embed(description=f'{opponent.mention} is not registered. They need to register first using $register.')
         await ctx.send(embed=embed)
         return
@@ -248,133 +373,40 @@ async def rep(ctx, result: str, opponent: discord.Member):
         await ctx.send(embed=embed)
         return
 
-    report_pending_match(ctx.author.id, opponent.id, result)
-    pending_matches = get_pending_matches(ctx.author.id, opponent.id)
-
-    for match in pending_matches:
-        if result == 'w':
-            if match[2] == 'l':
-                finalize_match(ctx.author.id, opponent.id, result, match[3])
-                delete_pending_match(ctx.author.id, opponent.id, match[3])
-                author_data = c.execute('SELECT rating, wins, losses, draws, rd FROM players WHERE discord_id = ?',
-                                        (ctx.author.id,)).fetchone()
-
-                opponent_data = c.execute('SELECT rating, wins, losses, draws, rd FROM players WHERE discord_id = ?',
-                                        (opponent.id,)).fetchone()
-
-                if author_data and opponent_data:
-
-                    if author_data[4] > rd_cutoff:
-                        a_added_marker = '?'
-                    else:
-                        a_added_marker = ''
-
-                    if opponent_data[4] > rd_cutoff:
-                        o_added_marker = '?'
-                    else:
-                        o_added_marker = ''
-
-                    response = (
-                        f"{ctx.author.mention}:\n"
-                        f"Rating: {round(author_data[0],1)}{a_added_marker}\n"
-                        f"Wins: {author_data[1]} | "
-                        f"Losses: {author_data[2]} | "
-                        f"Draws: {author_data[3]}\n\n"
-                        f"{opponent.mention}\n"
-                        f"Rating: {round(opponent_data[0],1)}{o_added_marker}\n"
-                        f"Wins: {opponent_data[1]} | "
-                        f"Losses: {opponent_data[2]} | "
-                        f"Draws: {opponent_data[3]}"
-                    )
-                    embed = discord.Embed(description=f'Match confirmed and reported: {ctx.author.mention} vs {opponent.mention}\n{response}')
-                    await ctx.send(embed=embed)
-                return
-        elif result == 'l':
-            if match[2] == 'w':
-                finalize_match(ctx.author.id, opponent.id, result, match[3])
-                delete_pending_match(ctx.author.id, opponent.id, match[3])
-
-                author_data = c.execute('SELECT rating, wins, losses, draws, rd FROM players WHERE discord_id = ?',
-                                        (ctx.author.id,)).fetchone()
-
-                opponent_data = c.execute('SELECT rating, wins, losses, draws, rd FROM players WHERE discord_id = ?',
-                                          (opponent.id,)).fetchone()
-
-                if author_data and opponent_data:
-
-                    if author_data[4] > rd_cutoff:
-                        a_added_marker = '?'
-                    else:
-                        a_added_marker = ''
-
-                    if opponent_data[4] > rd_cutoff:
-                        o_added_marker = '?'
-                    else:
-                        o_added_marker = ''
-
-                    response = (
-                        f"{ctx.author.mention}:\n"
-                        f"Rating: {round(author_data[0],1)}{a_added_marker}\n"
-                        f"Wins: {author_data[1]} | "
-                        f"Losses: {author_data[2]} | "
-                        f"Draws: {author_data[3]}\n\n"
-                        f"{opponent.mention}\n"
-                        f"Rating: {round(opponent_data[0],1)}{o_added_marker}\n"
-                        f"Wins: {opponent_data[1]} | "
-                        f"Losses: {opponent_data[2]} | "
-                        f"Draws: {opponent_data[3]}"
-                    )
-                    embed = discord.Embed(description=f'Match confirmed and reported: {ctx.author.mention} vs {opponent.mention}\n{response}')
-                    await ctx.send(embed=embed)
-                return
-        elif result == 'd':
-            if match[2] == 'd' and match[0] != ctx.author.id:
-                finalize_match(ctx.author.id, opponent.id, result, match[3])
-                delete_pending_match(ctx.author.id, opponent.id, match[3])
-
-                author_data = c.execute('SELECT rating, wins, losses, draws, rd FROM players WHERE discord_id = ?',
-                                        (ctx.author.id,)).fetchone()
-
-                opponent_data = c.execute('SELECT rating, wins, losses, draws, rd FROM players WHERE discord_id = ?',
-                                          (opponent.id,)).fetchone()
-
-                if author_data and opponent_data:
-
-                    if author_data[4] > rd_cutoff:
-                        a_added_marker = '?'
-                    else:
-                        a_added_marker = ''
-
-                    if opponent_data[4] > rd_cutoff:
-                        o_added_marker = '?'
-                    else:
-                        o_added_marker = ''
-
-                    response = (
-                        f"{ctx.author.mention}:\n"
-                        f"Rating: {round(author_data[0],1)}{a_added_marker}\n"
-                        f"Wins: {author_data[1]} | "
-                        f"Losses: {author_data[2]} | "
-                        f"Draws: {author_data[3]}\n\n"
-                        f"{opponent.mention}\n"
-                        f"Rating: {round(opponent_data[0],1)}{o_added_marker}\n"
-                        f"Wins: {opponent_data[1]} | "
-                        f"Losses: {opponent_data[2]} | "
-                        f"Draws: {opponent_data[3]}"
-                    )
-                    embed = discord.Embed(description=f'Match confirmed and reported: {ctx.author.mention} vs {opponent.mention}\n{response}')
-                    await ctx.send(embed=embed)
-                return
+    pending_reports = ladder.pending_reports
+    for match in pending_reports.between(ctx.author.id, opponent.id):
+        if match.reporter_id != ctx.author.id and match.result == COUNTERPARTS[result]:
+            # Claim the report before awaiting anything so it can't be confirmed twice
+            pending_reports.remove(match, journal=False)
+            updated = await finalize_match(ladder, ctx.author.id, opponent.id, result, (match,))
+            if updated is None:
+                # Nothing was committed, so it can be confirmed again
+                pending_reports.put_back(match)
+                embed = discord.Embed(description="An error occurred while confirming the match.")
+            else:
+                author_data, opponent_data = updated
+                response = (
+                    f"{ctx.author.mention}:\n"
+                    f"{format_player_stats(ladder, author_data, ladder.period_buffer.has_games(ctx.author.id))}\n\n"
+                    f"{opponent.mention}\n"
+                    f"{format_player_stats(ladder, opponent_data, ladder.period_buffer.has_games(opponent.id))}"
+                )
+                embed = discord.Embed(description=f'Match confirmed and reported: {ctx.author.mention} vs {opponent.mention}\n{response}')
+            await ctx.send(embed=embed)
+            return
 
+    pending_reports.add(ctx.author.id, opponent.id, result)
     embed = discord.Embed(description=f'Match reported: {ctx.author.mention} vs {opponent.mention} Awaiting confirmation from {opponent.mention}.')
     await ctx.send(embed=embed)
 
 @bot.command()
 async def cancel(ctx, opponent: discord.Member):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
-    pending_matches = get_pending_matches(ctx.author.id, opponent.id)
+    pending_reports = ladder.pending_reports
+    pending_matches = pending_reports.between(ctx.author.id, opponent.id)
 
     if not pending_matches:
         embed = discord.Embed(description=f'{ctx.author.mention}, there is no pending match report against {opponent.mention} to cancel.')
@@ -382,8 +414,8 @@ async def cancel(ctx, opponent: discord.Member):
         return
 
     for match in pending_matches:
-        if match[0] == ctx.author.id:
-            delete_pending_match(ctx.author.id, opponent.id, match[3])
+        if match.reporter_id == ctx.author.id:
+            pending_reports.remove(match)
             embed = discord.Embed(description=f'{ctx.author.mention}, your pending match report against {opponent.mention} has been canceled.')
             await ctx.send(embed=embed)
             return
@@ -391,77 +423,138 @@ async def cancel(ctx, opponent: discord.Member):
     embed = discord.Embed(description=f'{ctx.author.mention}, there is no pending match report against {opponent.mention} to cancel.')
     await ctx.send(embed=embed)
 
+async def render_rows(ladder, rows, title):
+    names = await ladder.name_cache.resolve_many([discord_id for _, discord_id, _ in rows])
+    response = f"{title}\n"
+    for rank, discord_id, rating in rows:
+        response += f"{rank}. {names[discord_id]} {round(rating,1)}\n"
+    return response
+
+async def render_top_10(ladder, view, title):
+    return await render_rows(ladder, view.top(10), title)
+
+PAGE_SIZE = 10
+
+class LeaderboardPages(discord.ui.View):
+    """Previous/next buttons under a leaderboard message.
+
+    Each turn fetches the page before the first or after the last row shown,
+    keyed on that row, from the rank index. Rendered pages are cached until
+    the leaderboard next changes. The buttons stop working after `timeout`
+    seconds, when discord.py lets go of the view.
+    """
+
+    def __init__(self, ladder, which, title, author_id, rows, timeout=180):
+        super().__init__(timeout=timeout)
+        self.ladder = ladder
+        self.which = which  # 'active' or 'all_time'
+        self.title = title
+        self.author_id = author_id
+        self.message = None
+        self._show(rows)
+
+    def ranked_view(self):
+        # Looked up on every turn: a recompute replaces the views
+        return getattr(self.ladder.rank_index, self.which)
+
+    def _show(self, rows):
+        self.rows = rows
+        self.previous_page.disabled = not rows or rows[0][0] == 1
+        self.next_page.disabled = not rows or rows[-1][0] >= len(self.ranked_view())
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message('Only the person who asked for this leaderboard can turn its pages.', ephemeral=True)
+            return False
+        return True
+
+    async def _render(self, direction, anchor):
+        view = self.ranked_view()
+        rows = view.page_after(anchor, PAGE_SIZE) if direction == 'after' else view.page_before(anchor, PAGE_SIZE)
+        return rows, await render_rows(self.ladder, rows, self.title)
+
+    async def _turn(self, interaction, direction):
+        try:
+            self.ladder.rank_index.expire(datetime.utcnow())
+            _, discord_id, rating = self.rows[-1] if direction == 'after' else self.rows[0]
+            anchor = (-rating, discord_id)
+            rows, response = await self.ladder.leaderboard_cache.get(
+                (self.title, direction, anchor), self.ranked_view().version, lambda: self._render(direction, anchor))
+            if not rows:
+                self._show(self.rows)
+                await interaction.response.edit_message(view=self)
+                return
+            self._show(rows)
+            await interaction.response.edit_message(embed=discord.Embed(description=response), view=self)
+        except Exception as e:
+            logging.error(f"Error turning leaderboard page: {e}")
+            # Unanswered, Discord shows the user "This interaction failed"
+            if not interaction.response.is_done():
+                try:
+                    await interaction.response.send_message("An error occurred while turning the page.", ephemeral=True)
+                except discord.HTTPException as e:
+                    logging.error(f"Error answering leaderboard button: {e}")
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._turn(interaction, 'before')
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._turn(interaction, 'after')
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+async def send_leaderboard(ctx, ladder, which, title, rk):
+    view = getattr(ladder.rank_index, which)
+    response = await render_leaderboard(ctx, ladder, view, title, rk)
+    embed = discord.Embed(description=response)
+    pages = LeaderboardPages(ladder, which, title, ctx.author.id, view.top(PAGE_SIZE))
+    pages.message = await ctx.send(embed=embed, view=pages)
+
+async def render_leaderboard(ctx, ladder, view, title, rk):
+    response = await ladder.leaderboard_cache.get(title, view.top_version, lambda: render_top_10(ladder, view, title))
+    extra_rows = []
+
+    player_data = ladder.players.get(ctx.author.id)
+
+    if player_data and player_data.matches_played >= ladder.min_matches:
+        if rk is None:
+            # Show the author and their neighbours when they aren't already in the top 10
+            rank = view.rank(ctx.author.id)
+            if rank is not None and rank > 10:
+                extra_rows = view.range(rank - 1, rank + 1)
+        elif rk > 9:
+            extra_rows = view.range(rk - 1, rk + 1)
+
+    names = await ladder.name_cache.resolve_many([discord_id for _, discord_id, _ in extra_rows])
+    names[ctx.author.id] = ctx.author.name
+
+    if player_data and player_data.matches_played < ladder.min_matches:
+        response += f"\nYou must report at least {ladder.min_matches} rated matches to be placed on the leaderboard."
+
+    for rank, discord_id, rating in extra_rows:
+        response += f"\n{rank}. {names[discord_id]} {round(rating, 1)}"
+
+    return response
+
 @bot.command()
 async def leaderboard(ctx, rk: int = None):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
     try:
-        three_months_ago = datetime.utcnow() - timedelta(days=90)
-        c.execute('SELECT * FROM players WHERE last_match >= ? AND matches_played >= 4 ORDER BY rating DESC LIMIT 10',
-                  (three_months_ago.isoformat(),))
-        top_10 = c.fetchall()
-        response = "Leaderboard (last 3 months):\n"
-        for i, player_data in enumerate(top_10, start=1):
-
-            player_user = get_fetch_user(bot, player_data[0])
-            user_name = player_user.name
-
-            response += f"{i}. {user_name} {round(player_data[1],1)}\n"
-
-        player_data = c.execute('SELECT matches_played, rating, rd FROM players WHERE discord_id = ?',
-                                   (ctx.author.id,)).fetchone()
-
-        author_name = ctx.author.name
-
-        if player_data:
-            if player_data[0] < 4:
-                response += "\nYou must report at least 4 rated matches to be placed on the leaderboard."
-            else:
-                c.execute(
-                    'SELECT * FROM players WHERE last_match >= ? AND matches_played >= 4 ORDER BY rating DESC',
-                    (three_months_ago.isoformat(),))
-                ranked_list = c.fetchall()
-                for index, player_data in enumerate(ranked_list):
-                    rank = index + 1
-                    if rk is None:
-                        if player_data and author_name not in response:
-                            if player_data[0] == ctx.author.id:
-
-                                if rank > 1:
-                                    player_data_up = ranked_list[rank - 1]
-                                    h_user = get_fetch_user(bot, player_data_up[0])
-                                    h_user_name = h_user.name
-                                    response += f"\n{rank - 1}. {h_user_name} {round(player_data_up[1], 1)}"
-
-                                response += f"\n{rank}. {ctx.author.name} {round(player_data[1],1)}"
-
-                                if rank < len(ranked_list):
-                                    player_data_down = ranked_list[rank + 1]
-                                    d_user = get_fetch_user(bot, player_data_down[0])
-                                    d_user_name = d_user.name
-                                    response += f"\n{rank + 1}. {d_user_name} {round(player_data_down[1], 1)}"
-                    else:
-                        if rank == rk and rk > 9:
-
-                            player_data_up = ranked_list[rank - 1]
-                            h_user = get_fetch_user(bot, player_data_up[0])
-                            h_user_name = h_user.name
-                            response += f"\n{rank - 1}. {h_user_name} {round(player_data_up[1], 1)}"
-
-                            user = get_fetch_user(bot, player_data[0])
-                            user_name = user.name
-                            response += f"\n{rank}. {user_name} {round(player_data[1], 1)}"
-
-                            if rk < len(ranked_list):
-                                player_data_down = ranked_list[rank + 1]
-                                d_user = get_fetch_user(bot, player_data_down[0])
-                                d_user_name = d_user.name
-                                response += f"\n{rank + 1}. {d_user_name} {round(player_data_down[1], 1)}"
-
-
-        embed = discord.Embed(description=response)
-        await ctx.send(embed=embed)
+        await load_rank_index(ladder)
+        ladder.rank_index.expire(datetime.utcnow())
+        await send_leaderboard(ctx, ladder, 'active', f"Leaderboard (last {ladder.active_window.days} days):", rk)
     except Exception as e:
         logging.error(f"Error fetching leaderboard: {e}")
         embed = discord.Embed(description="An error occurred while fetching the leaderboard.")
@@ -469,72 +562,13 @@ async def leaderboard(ctx, rk: int = None):
 
 @bot.command()
 async def stale_leaderboard(ctx, rk: int = None):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
     try:
-        c.execute('SELECT * FROM players WHERE matches_played >= 4 ORDER BY rating DESC LIMIT 10')
-        top_10 = c.fetchall()
-        response = "Leaderboard:\n"
-        for i, player_data in enumerate(top_10, start=1):
-
-            player_user = get_fetch_user(bot, player_data[0])
-            user_name = player_user.name
-
-            response += f"{i}. {user_name} {round(player_data[1],1)}\n"
-
-        player_data = c.execute('SELECT matches_played, rating, rd FROM players WHERE discord_id = ?',
-                                   (ctx.author.id,)).fetchone()
-
-        author_name = ctx.author.name
-
-        if player_data:
-            if player_data[0] < 4:
-                response += "\nYou must report at least 4 rated matches to be placed on the leaderboard."
-            else:
-                c.execute(
-                    'SELECT * FROM players WHERE matches_played >= 4 ORDER BY rating DESC'
-                )
-                ranked_list = c.fetchall()
-                for index, player_data in enumerate(ranked_list):
-                    rank = index + 1
-                    if rk is None:
-                        if player_data and author_name not in response:
-                            if player_data[0] == ctx.author.id:
-
-                                if rank > 1:
-                                    player_data_up = ranked_list[rank - 1]
-                                    h_user = get_fetch_user(bot, player_data_up[0])
-                                    h_user_name = h_user.name
-                                    response += f"\n{rank - 1}. {h_user_name} {round(player_data_up[1], 1)}"
-
-                                response += f"\n{rank}. {ctx.author.name} {round(player_data[1],1)}"
-
-                                if rank < len(ranked_list):
-                                    player_data_down = ranked_list[rank + 1]
-                                    d_user = get_fetch_user(bot, player_data_down[0])
-                                    d_user_name = d_user.name
-                                    response += f"\n{rank + 1}. {d_user_name} {round(player_data_down[1], 1)}"
-                    else:
-                        if rank == rk and rk > 9:
-
-                            player_data_up = ranked_list[rank-1]
-                            h_user = get_fetch_user(bot,player_data_up[0])
-                            h_user_name = h_user.name
-                            response += f"\n{rank-1}. {h_user_name} {round(player_data_up[1], 1)}"
-
-                            user = get_fetch_user(bot,player_data[0])
-                            user_name = user.name
-                            response += f"\n{rank}. {user_name} {round(player_data[1], 1)}"
-
-                            if rk < len(ranked_list):
-                                player_data_down = ranked_list[rank+1]
-                                d_user = get_fetch_user(bot,player_data_down[0])
-                                d_user_name = d_user.name
-                                response += f"\n{rank+1}. {d_user_name} {round(player_data_down[1], 1)}"
-
-        embed = discord.Embed(description=response)
-        await ctx.send(embed=embed)
+        await load_rank_index(ladder)
+        await send_leaderboard(ctx, ladder, 'all_time', "Leaderboard:", rk)
     except Exception as e:
         logging.error(f"Error fetching leaderboard: {e}")
         embed = discord.Embed(description="An error occurred while fetching the leaderboard.")
@@ -542,25 +576,18 @@ async def stale_leaderboard(ctx, rk: int = None):
 
 @bot.command()
 async def stats(ctx):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
     try:
-        player_data = c.execute('SELECT rating, wins, losses, draws, rd FROM players WHERE discord_id = ?',
-                                (ctx.author.id,)).fetchone()
+        player_data = ladder.players.get(ctx.author.id)
         if player_data:
-            if player_data[4] > rd_cutoff:
-                added_marker = '?'
-            else:
-                added_marker = ''
-
-            response = (
-                f"{ctx.author.mention}, here are your stats:\n"
-                f"Rating: {round(player_data[0],1)}{added_marker}\n"
-                f"Wins: {player_data[1]} | "
-                f"Losses: {player_data[2]} | "
-                f"Draws: {player_data[3]}"
-            )
+            rd = ladder.effective_rd(player_data.rd, player_data.vol, player_data.rd_updated, to_epoch(datetime.utcnow()))
+            rating, rd, _ = ladder.period_buffer.provisional(ctx.author.id, player_data.rating, rd, player_data.vol)
+            player_data = (rating, player_data.wins, player_data.losses, player_data.draws, rd)
+            provisional = ladder.period_buffer.has_games(ctx.author.id)
+            response = f"{ctx.author.mention}, here are your stats:\n{format_player_stats(ladder, player_data, provisional)}"
         else:
             response = f"{ctx.author.mention}, you are not registered. Use $register to register."
         embed = discord.Embed(description=response)
@@ -570,40 +597,357 @@ async def stats(ctx):
         embed = discord.Embed(description="An error occurred while fetching your stats.")
         await ctx.send(embed=embed)
 
+def match_found_embed(first, second):
+    return discord.Embed(description=f'Match found: <@{first.discord_id}> ({round(first.rating)}) vs <@{second.discord_id}> ({round(second.rating)}). '
+                                     'Report the result with $rep once you have played.')
+
 @bot.command()
 async def looking(ctx):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
     try:
-        role = discord.utils.get(ctx.guild.roles, name='Looking')
-        if role in ctx.author.roles:
-            await ctx.author.remove_roles(role)
+        match_queue = ladder.match_queue
+        if match_queue.leave(ctx.author.id) is not None:
             embed = discord.Embed(description=f'{ctx.author.mention} is no longer looking for a match.')
             await ctx.send(embed=embed)
+            return
+
+        player = ladder.players.get(ctx.author.id)
+        if player is None:
+            embed = discord.Embed(description=f'{ctx.author.mention}, you need to register first using $register.')
+            await ctx.send(embed=embed)
+            return
+
+        rd = ladder.effective_rd(player.rd, player.vol, player.rd_updated, to_epoch(datetime.utcnow()))
+        rating, _, _ = ladder.period_buffer.provisional(ctx.author.id, player.rating, rd, player.vol)
+        opponent = match_queue.join(ctx.author.id, rating)
+        if opponent is None:
+            embed = discord.Embed(description=f'{ctx.author.mention} is now looking for a match ({len(match_queue)} in the queue).')
+            await ctx.send(embed=embed)
         else:
-            await ctx.author.add_roles(role)
-            embed = discord.Embed(description=f'{ctx.author.mention} is now looking for a match.')
+            # Embeds don't ping, so mention both players in the message itself
+            await ctx.send(f'<@{opponent.discord_id}> {ctx.author.mention}', embed=match_found_embed(opponent, QueueEntry(ctx.author.id, rating, None)))
+    except Exception as e:
+        logging.error(f"Error updating the matchmaking queue: {e}")
+        embed = discord.Embed(description="An error occurred while updating the matchmaking queue.")
+        await ctx.send(embed=embed)
+
+@tasks.loop(seconds=5)
+async def run_matchmaking():
+    # Pairs whose rating windows have grown to fit, and players who waited too long
+    for ladder in LADDERS:
+        try:
+            matches = ladder.match_queue.pop_matches()
+            expired = ladder.match_queue.expire()
+            if not matches and not expired:
+                continue
+            channel = bot.get_channel(ladder.channel_id)
+            if channel is None:
+                continue
+            for first, second in matches:
+                await channel.send(f'<@{first.discord_id}> <@{second.discord_id}>', embed=match_found_embed(first, second))
+            for entry in expired:
+                minutes = round(ladder.queue_timeout.total_seconds() / 60)
+                embed = discord.Embed(description=f'<@{entry.discord_id}>, no opponent was found within {minutes} minutes, '
+                                                  'so you have left the queue. Use $looking to join again.')
+                await channel.send(f'<@{entry.discord_id}>', embed=embed)
+        except Exception as e:
+            logging.error(f"Error running matchmaking: {e}")
+
+async def rating_history(ladder, discord_id):
+    # (played_at epochs, ratings): the rating before the first rated game, then after every one.
+    # Matches imported without --replay have no before/after ratings and are left out
+    rows = await ladder.db.fetchall(
+        'SELECT id, played_at, reporter_rating_before, reporter_rating_after FROM matches '
+        'WHERE reporter_id = ? AND rated = 1 AND voided = 0 AND reporter_rating_after IS NOT NULL '
+        'UNION ALL SELECT id, played_at, opponent_rating_before, opponent_rating_after FROM matches '
+        'WHERE opponent_id = ? AND rated = 1 AND voided = 0 AND opponent_rating_after IS NOT NULL '
+        'ORDER BY id', (discord_id, discord_id))
+    if not rows:
+        return [], []
+    return [rows[0][1]] + [row[1] for row in rows], [rows[0][2]] + [row[3] for row in rows]
+
+async def render_history(ladder, discord_id, name):
+    # (PNG bytes or None without matplotlib, summary text)
+    global chart_pool
+    times, ratings = await rating_history(ladder, discord_id)
+    if not ratings:
+        return None, None
+    summary = (f"{len(ratings) - 1} rated games. Started at {round(ratings[0], 1)}, "
+               f"peak {round(max(ratings), 1)}, now {round(ratings[-1], 1)}.")
+    times, ratings = charts.downsample(times, ratings)
+    if not charts.available():
+        return None, f"{summary}\n{charts.sparkline(ratings)}"
+    if chart_pool is None:
+        # Spawned, not forked: forking this process, with its database threads running, can
+        # leave a lock held in the child
+        chart_pool = ProcessPoolExecutor(max_workers=chart_workers, mp_context=multiprocessing.get_context('spawn'))
+    png = await asyncio.get_running_loop().run_in_executor(chart_pool, charts.render_png, times, ratings, f"{name}'s rating")
+    return png, summary
+
+@bot.command()
+async def history(ctx, member: discord.Member = None):
+    ladder = get_ladder(ctx)
+    if ladder is None:
+        return
+
+    member = member or ctx.author
+    try:
+        player = ladder.players.get(member.id)
+        if player is None:
+            embed = discord.Embed(description=f'{member.mention} is not registered.')
+            await ctx.send(embed=embed)
+            return
+
+        png, summary = await ladder.chart_cache.get(member.id, (player.matches_played, player.rating),
+                                                    lambda: render_history(ladder, member.id, member.name))
+        if summary is None:
+            embed = discord.Embed(description=f'{member.mention} has no rated games yet.')
             await ctx.send(embed=embed)
+            return
+        embed = discord.Embed(description=f"{member.mention}'s rating history:\n{summary}")
+        if png is None:
+            await ctx.send(embed=embed)
+            return
+        embed.set_image(url='attachment://history.png')
+        await ctx.send(embed=embed, file=discord.File(io.BytesIO(png), filename='history.png'))
+    except Exception as e:
+        logging.error(f"Error showing rating history: {e}")
+        embed = discord.Embed(description="An error occurred while fetching the rating history.")
+        await ctx.send(embed=embed)
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def recompute_ratings(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
+        return
+
+    try:
+        started = datetime.utcnow()
+        replayed = await ladder.db.transaction(
+            lambda conn: recompute(conn, ladder.int_rating, ladder.int_rd, ladder.int_vol, ladder.decay_period()))
+        _, columns = await ladder.db.read(scan_players)
+        ladder.players.fill(columns)
+        await load_rank_index(ladder, reload=True)
+        if ladder.rating_period is not None:
+            # The open period's games were replayed against new start-of-period ratings
+            ladder.period_buffer.clear()
+            await load_period_buffer(ladder)
+        seconds = (datetime.utcnow() - started).total_seconds()
+        embed = discord.Embed(description=f'Recomputed all ratings from {replayed} matches in {seconds:.1f}s.')
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logging.error(f"Error recomputing ratings: {e}")
+        embed = discord.Embed(description="An error occurred while recomputing ratings.")
+        await ctx.send(embed=embed)
+
+@bot.command(name='round')
+@commands.check_any(commands.has_permissions(administrator=True), commands.has_role(organizer_role))
+async def submit_round(ctx, *, results: str = ''):
+    ladder = get_ladder(ctx)
+    if ladder is None:
+        return
+
+    try:
+        if ctx.message.attachments:
+            results = (await ctx.message.attachments[0].read()).decode('utf-8-sig')
+        games = parse_round(results.strip().strip('`'))
+    except (InvalidRow, UnicodeDecodeError) as e:
+        embed = discord.Embed(description=f'Round not recorded:\n{e}'[:4096])
+        await ctx.send(embed=embed)
+        return
+
+    try:
+        # Instant ladders rate the whole round as one rating period; the others add it to the open period
+        rate = ladder.rating_period is None
+        match_ids, before, shown_rd, records, updated, now = await ladder.db.transaction(
+            lambda conn: apply_round(conn, games, ladder.int_rd, ladder.decay_period(), rate, ladder.effective_rd))
+    except InvalidRow as e:
+        embed = discord.Embed(description=f'Round not recorded: {e}'[:4096])
+        await ctx.send(embed=embed)
+        return
     except Exception as e:
-        logging.error(f"Error toggling looking role: {e}")
-        embed = discord.Embed(description="An error occurred while toggling the looking role.")
+        logging.error(f"Error recording round: {e}")
+        embed = discord.Embed(description="An error occurred while recording the round.")
+        await ctx.send(embed=embed)
+        return
+
+    if not rate:
+        for match_id, (reporter_id, opponent_id, result) in zip(match_ids, games):
+            ladder.period_buffer.add(match_id, reporter_id, opponent_id, (before[reporter_id][1], shown_rd[reporter_id]),
+                                     (before[opponent_id][1], shown_rd[opponent_id]), result)
+
+    last_match = from_epoch(now)
+    lines = []
+    for discord_id, row in before.items():
+        wins, losses, draws = (row[5 + i] + records[discord_id][i] for i in range(3))
+        rating, rd, vol, rd_updated = (*updated[discord_id], now) if rate else row[1:5]
+        ladder.players.put(PlayerRow(discord_id, rating, rd, vol, rd_updated, now, wins, losses, draws, row[8] + sum(records[discord_id])))
+        ladder.rank_index.update(discord_id, rating, row[8] + sum(records[discord_id]), last_match)
+        shown_rating, _, _ = ladder.period_buffer.provisional(discord_id, rating, rd, vol)
+        lines.append((shown_rating - row[1], f'<@{discord_id}> {row[1]:.1f} → {shown_rating:.1f} ({shown_rating - row[1]:+.1f})'))
+
+    lines.sort(key=lambda line: line[0], reverse=True)
+    header = f'Round recorded: {len(games)} games, {len(before)} players' + ('.' if rate else ', rated when the period closes (provisional ratings).')
+    response = header + '\n\n' + '\n'.join(line for _, line in lines)
+    if len(response) > 4096:
+        response = response[:4096].rsplit('\n', 1)[0]
+    embed = discord.Embed(description=response)
+    await ctx.send(embed=embed)
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def backup(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
+        return
+
+    try:
+        started = time.perf_counter()
+        path, size = await back_up(ladder)
+        embed = discord.Embed(description=f'Backed up {ladder.name} to {path} ({size / 2**20:.1f} MB) '
+                                          f'in {time.perf_counter() - started:.1f}s.')
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logging.error(f"Error backing up: {e}")
+        embed = discord.Embed(description="An error occurred while backing up.")
+        await ctx.send(embed=embed)
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def restore_backup(ctx, when: str = 'latest'):
+    # when is 'latest' or a UTC time such as 2024-01-31T12:00; the newest backup taken by then is restored
+    ladder = get_ladder(ctx)
+    if ladder is None:
+        return
+
+    try:
+        at = None if when == 'latest' else datetime.fromisoformat(when)
+    except ValueError:
+        embed = discord.Embed(description="Give 'latest' or a UTC time such as 2024-01-31T12:00.")
+        await ctx.send(embed=embed)
+        return
+
+    try:
+        async with ladder.backup_lock:
+            loop = asyncio.get_running_loop()
+            try:
+                taken_at, path, (players, matches, _) = await loop.run_in_executor(
+                    None, prepare_restore, ladder.path, ladder.backup_dir, at)
+            except ValueError as e:
+                embed = discord.Embed(description=f'Not restored: {e}')
+                await ctx.send(embed=embed)
+                return
+
+            # Verified; switch over with the channel's commands ignored meanwhile
+            del ladders[ladder.channel_id]
+            try:
+                await ladder.restore(f'{ladder.path}.restore', bot, observer=metrics.observe_query)
+                await start_ladder(ladder)
+            finally:
+                ladders[ladder.channel_id] = ladder
+        logging.info(f'{ladder.name}: restored the database from {path}.')
+        embed = discord.Embed(description=f'Restored {ladder.name} from the backup of {taken_at:%Y-%m-%d %H:%M:%S} UTC '
+                                          f'({players} players, {matches} matches). The replaced database was kept '
+                                          f'as {ladder.path}.before-restore.')
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logging.error(f"Error restoring backup: {e}")
+        embed = discord.Embed(description="An error occurred while restoring the backup.")
+        await ctx.send(embed=embed)
+
+@bot.command(name='metrics')
+@commands.has_permissions(administrator=True)
+async def show_metrics(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
+        return
+
+    try:
+        response = metrics.summary()
+        leaderboard_cache, name_cache = ladder.leaderboard_cache, ladder.name_cache
+        lookups = leaderboard_cache.hits + leaderboard_cache.misses
+        if lookups:
+            response += f'\n{ladder.name} leaderboard cache: {leaderboard_cache.hits / lookups:.0%} hits of {lookups} renders'
+        lookups = name_cache.hits + name_cache.db_hits + name_cache.fetches
+        if lookups:
+            response += f'\n{ladder.name} name cache: {name_cache.hits / lookups:.0%} from memory, {name_cache.fetches} API fetches'
+        embed = discord.Embed(description=response[:4096])
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logging.error(f"Error showing metrics: {e}")
+        embed = discord.Embed(description="An error occurred while collecting the metrics.")
+        await ctx.send(embed=embed)
+
+@bot.command(name='profile')
+@commands.has_permissions(administrator=True)
+async def profile_commands(ctx, action: str = 'status', rate: float = 0.1):
+    # $profile on [fraction] | off | clear | dump | status
+    ladder = get_ladder(ctx)
+    if ladder is None:
+        return
+
+    try:
+        if action == 'on':
+            if not 0 < rate <= 1:
+                embed = discord.Embed(description='The sampled fraction must be in (0, 1].')
+                await ctx.send(embed=embed)
+                return
+            profiler.rate = rate
+            embed = discord.Embed(description=f'Profiling {rate:.0%} of commands.')
+        elif action == 'off':
+            profiler.rate = 0
+            embed = discord.Embed(description=f'Profiling stopped; {len(profiler.samples)} samples kept.')
+        elif action == 'clear':
+            profiler.clear()
+            embed = discord.Embed(description='Profile samples cleared.')
+        elif action == 'dump':
+            if not profiler.samples:
+                embed = discord.Embed(description='No profile samples yet; start with $profile on.')
+                await ctx.send(embed=embed)
+                return
+            # pstats and tracemalloc work through the samples for a while; keep the event loop free
+            archive = await asyncio.get_running_loop().run_in_executor(None, profiler.dump, profile_dir)
+            embed = discord.Embed(description=f'Profiles of {len(profiler.samples)} samples written to {profile_dir}/ '
+                                              f'(pstats, collapsed stacks for flamegraphs, allocation sites).')
+            await ctx.send(embed=embed, file=discord.File(io.BytesIO(archive), filename='profiles.zip'))
+            return
+        elif action == 'status':
+            lines = [f'Sampling {profiler.rate:.0%} of commands, {len(profiler.samples)} samples kept.']
+            for command, samples in sorted(profiler.commands().items()):
+                lines.append(f'\n**{command}** ({samples} samples)')
+                lines += [f'{tt * 1000:.2f} ms own, {ct * 1000:.2f} ms total: {function}'
+                          for function, tt, ct in profiler.hotspots(command, count=3)]
+                lines += [f'{size / 1024:.0f} KiB held: {site}' for site, size, _ in profiler.allocation_sites(command, count=1)]
+            embed = discord.Embed(description='\n'.join(lines)[:4096])
+        else:
+            embed = discord.Embed(description='Use $profile on [fraction], off, clear, dump or status.')
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logging.error(f"Error profiling commands: {e}")
+        embed = discord.Embed(description="An error occurred while profiling commands.")
         await ctx.send(embed=embed)
 
 @bot.command()
 async def help_bot(ctx):
-    if not is_allowed_channel(ctx):
+    ladder = get_ladder(ctx)
+    if ladder is None:
         return
 
     try:
         response = (
-            "$register - Register yourself with a starting rating of 1400.\n"
+            f"$register - Register yourself with a starting rating of {ladder.int_rating}.\n"
             "$rep [w/l/d] @opponent - Report a match result.\n"
             "$cancel @opponent - Cancel your pending match report against the opponent.\n"
             "$leaderboard - Display the leaderboard.\n"
             "$stale_leaderboard - Display the leaderboard of people who don't play matches.\n"
             "$stats - Show your rating and the number of wins, losses, and draws.\n"
-            "$looking - Toggle the looking role.\n"
+            "$history [@player] - Chart your (or the player's) rating over time.\n"
+            "$round - Organizers: submit a round's results, one game per line (@player @opponent w/l/d) or an attached CSV.\n"
+            "$looking - Join or leave the matchmaking queue; you are paired with the closest rated player looking.\n"
             "$help_bot - Display this help message."
         )
         embed = discord.Embed(description=response)
@@ -613,16 +957,19 @@ async def help_bot(ctx):
         embed = discord.Embed(description="An error occurred while displaying the help message.")
         await ctx.send(embed=embed)
 
-# Remember to replace 'YOUR_BOT_TOKEN' with your actual bot token
-with open('bot_token.txt', 'r') as file:
-    for line in file:
-        if ' = ' in line:
-            line_list = line.split(' = ')
-            token = line_list[-1]
-            token = token.replace('\n', '')
-            bot.run(token)
-
-# Close the database connection when the bot stops
-@bot.event
-async def on_disconnect():
-    conn.close()
+if __name__ == '__main__':
+    # Remember to replace 'YOUR_BOT_TOKEN' with your actual bot token
+    with open('bot_token.txt', 'r') as file:
+        for line in file:
+            if ' = ' in line:
+                line_list = line.split(' = ')
+                token = line_list[-1]
+                token = token.replace('\n', '')
+                bot.run(token)
+
+    # Close the database connections when the bot stops. Not on_disconnect: the
+    # gateway disconnects and resumes routinely while the bot keeps running.
+    for ladder in LADDERS:
+        ladder.close()
+    if chart_pool is not None:
+        chart_pool.shutdown()
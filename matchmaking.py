@@ -0,0 +1,133 @@
+import heapq
+import itertools
+import time
+from collections import namedtuple
+
+from ranking import IndexableSkipList
+
+
+QueueEntry = namedtuple('QueueEntry', ['discord_id', 'rating', 'joined'])
+
+
+class MatchQueue:
+    """Players looking for a game, kept sorted by rating.
+
+    A player accepts opponents within `window` rating points of themselves,
+    widening by `growth` points per second of waiting up to `max_window`. Two
+    players are paired once the gap between them fits both their windows.
+
+    The closest-rated opponent is always a neighbour in rating order, so only
+    neighbouring pairs are considered. Each gets an event for the moment it
+    becomes acceptable; events of pairs that stopped being neighbours are
+    skipped when they come up. Joining, leaving and each pairing are O(log n).
+    Times are time.monotonic() seconds.
+    """
+
+    def __init__(self, window=50, growth=2.5, max_window=400, timeout=15 * 60):
+        self.window = window
+        self.growth = growth
+        self.max_window = max_window
+        self.timeout = timeout
+        self._list = IndexableSkipList()  # (rating, discord_id)
+        self._entries = {}  # discord_id -> QueueEntry
+        self._events = []  # heap of (when, sequence, lower QueueEntry, higher QueueEntry)
+        self._timeouts = []  # heap of (joined + timeout, sequence, QueueEntry)
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, discord_id):
+        return discord_id in self._entries
+
+    @staticmethod
+    def _key(entry):
+        return entry.rating, entry.discord_id
+
+    def _acceptable_at(self, low, high):
+        # When the later joiner's window (the narrower one) first reaches the gap
+        gap = abs(high.rating - low.rating)
+        if gap > self.max_window:
+            return None
+        if gap <= self.window:
+            return max(low.joined, high.joined)
+        return max(low.joined, high.joined) + (gap - self.window) / self.growth
+
+    def _neighbours(self, key):
+        index = self._list.bisect_left(key)
+        before = self._list[index - 1] if index > 0 else None
+        after = self._list[index + 1] if index + 1 < len(self._list) else None
+        return before, after
+
+    def _watch(self, low_key, high_key):
+        if low_key is None or high_key is None:
+            return
+        low, high = self._entries[low_key[1]], self._entries[high_key[1]]
+        when = self._acceptable_at(low, high)
+        if when is not None:
+            heapq.heappush(self._events, (when, next(self._sequence), low, high))
+
+    def _remove(self, discord_id):
+        entry = self._entries.pop(discord_id)
+        key = self._key(entry)
+        before, after = self._neighbours(key)
+        self._list.remove(key)
+        self._watch(before, after)
+        return entry
+
+    def join(self, discord_id, rating, now=None):
+        """Queue a player; returns their opponent's QueueEntry if one is acceptable right away, else None."""
+        now = time.monotonic() if now is None else now
+        if discord_id in self._entries:
+            return None
+        entry = QueueEntry(discord_id, rating, now)
+        key = self._key(entry)
+        self._entries[discord_id] = entry
+        self._list.insert(key)
+        heapq.heappush(self._timeouts, (now + self.timeout, next(self._sequence), entry))
+
+        before, after = self._neighbours(key)
+        candidates = []
+        for other in (before, after):
+            if other is not None:
+                when = self._acceptable_at(entry, self._entries[other[1]])
+                if when is not None and when <= now:
+                    candidates.append((abs(other[0] - rating), other[1]))
+        if candidates:
+            _, opponent_id = min(candidates)
+            self._remove(discord_id)
+            return self._remove(opponent_id)
+
+        self._watch(before, key)
+        self._watch(key, after)
+        return None
+
+    def leave(self, discord_id):
+        if discord_id not in self._entries:
+            return None
+        return self._remove(discord_id)
+
+    def pop_matches(self, now=None):
+        """[(QueueEntry, QueueEntry)] of every pair that has become acceptable, removed from the queue."""
+        now = time.monotonic() if now is None else now
+        matches = []
+        while self._events and self._events[0][0] <= now:
+            _, _, low, high = heapq.heappop(self._events)
+            # Stale: one of them left (and maybe queued again), or someone joined in between
+            if self._entries.get(low.discord_id) is not low or self._entries.get(high.discord_id) is not high:
+                continue
+            if self._list.bisect_left(self._key(high)) != self._list.bisect_left(self._key(low)) + 1:
+                continue
+            matches.append((self._remove(low.discord_id), self._remove(high.discord_id)))
+        return matches
+
+    def expire(self, now=None):
+        """[QueueEntry] of the players who waited `timeout` seconds without a match, removed from the queue."""
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self._timeouts and self._timeouts[0][0] <= now:
+            _, _, entry = heapq.heappop(self._timeouts)
+            # Matched or left meanwhile, maybe queued again since
+            if self._entries.get(entry.discord_id) is entry:
+                expired.append(self._remove(entry.discord_id))
+        return expired
@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, so an overestimate
+        if not self.count:
+            return 0.0
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+
+def resident_memory():
+    """Bytes of memory the process has resident now, its peak where /proc isn't available, or None."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _query_name(name):
+    # SQL text is a fine label as long as it is static; collapse the variable
+    # length IN (?, ?, ...) lists so each query keeps a single series
+    name = ' '.join(name.split()).replace('.<locals>', '')
+    return re.sub(r'\?(, \?)+', '?, ...', name)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class ErrorCounter(logging.Handler):
+    """Counts logged errors by the function that logged them."""
+
+    def __init__(self, counts):
+        super().__init__(logging.ERROR)
+        self.counts = counts
+        self._counts_lock = threading.Lock()
+
+    def emit(self, record):
+        # Errors are also logged from the database threads
+        with self._counts_lock:
+            self.counts[record.funcName] += 1
+
+    def snapshot(self):
+        with self._counts_lock:
+            return dict(self.counts)
+
+
+class Metrics:
+    """Latency, throughput and error counters for the bot.
+
+    Command and query timings are recorded on the event loop and kept as
+    fixed-bucket histograms. render() returns them in the Prometheus text
+    format, and start() can serve that on a local HTTP port.
+    """
+
+    prefix = 'glicko_bot'
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = defaultdict(Histogram)  # (command, status) -> Histogram
+        self.queries = defaultdict(Histogram)  # (kind, query, status) -> Histogram
+        self.errors = defaultdict(int)  # function that logged the error -> count
+        self.command_errors = defaultdict(int)  # exception type -> count
+        self.loop_lag = Histogram()
+        self._gauges = {}  # name -> (help, type, fn)
+        self._tasks = set()
+        self._server = None
+        self._error_counter = ErrorCounter(self.errors)
+        logging.getLogger().addHandler(self._error_counter)
+
+    def observe_command(self, command, seconds, failed=False):
+        self.commands[command, 'failed' if failed else 'ok'].observe(seconds)
+
+    def observe_query(self, kind, name, seconds, failed=False):
+        # Database observer: kind is 'read' or 'write', name the SQL or the function run
+        self.queries[kind, _query_name(name), 'failed' if failed else 'ok'].observe(seconds)
+
+    def gauge(self, name, help, fn, type='gauge'):
+        """Export the value of fn() at every scrape, e.g. a cache's hit counter."""
+        self._gauges[name] = (help, type, fn)
+
+    async def watch_loop_lag(self, interval=0.5):
+        # How late a sleep wakes up is how long something else held the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(loop.time() - expected, 0))
+
+    async def start(self, port=None, host='127.0.0.1'):
+        """Start watching event loop lag and, with a port, serving /metrics. Safe to call again."""
+        if not self._tasks:
+            task = asyncio.create_task(self.watch_loop_lag())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if port is not None and self._server is None:
+            self._server = await asyncio.start_server(self._handle, host, port)
+            logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    def _histogram_lines(self, name, help, histograms):
+        lines = [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+        for labels, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f'{name}_bucket{_labels(**labels, le=le)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum}')
+            lines.append(f'{name}_count{_labels(**labels)} {histogram.count}')
+        return lines
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        p = self.prefix
+        lines = self._histogram_lines(
+            f'{p}_command_duration_seconds', 'Time to run a command.',
+            [(dict(command=command, status=status), h) for (command, status), h in sorted(self.commands.items())])
+        lines += self._histogram_lines(
+            f'{p}_query_duration_seconds', 'Time from issuing a database read or write to its result, queueing included.',
+            [(dict(kind=kind, query=query, status=status), h) for (kind, query, status), h in sorted(self.queries.items())])
+        lines += self._histogram_lines(f'{p}_event_loop_lag_seconds', 'How late the event loop ran a scheduled wakeup.',
+                                       [({}, self.loop_lag)])
+
+        lines += [f'# HELP {p}_errors_total Errors logged, by the function that logged them.', f'# TYPE {p}_errors_total counter']
+        lines += [f'{p}_errors_total{_labels(function=where)} {count}' for where, count in sorted(self._error_counter.snapshot().items())]
+        lines += [f'# HELP {p}_command_errors_total Commands that raised, by exception type.', f'# TYPE {p}_command_errors_total counter']
+        lines += [f'{p}_command_errors_total{_labels(error=error)} {count}' for error, count in sorted(self.command_errors.items())]
+
+        lines += [f'# HELP {p}_start_time_seconds Unix time the bot started.', f'# TYPE {p}_start_time_seconds gauge',
+                  f'{p}_start_time_seconds {self.started}']
+        for name, (help, type, fn) in self._gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                logging.error(f"Error reading metric {name}: {e}")
+                continue
+            lines += [f'# HELP {p}_{name} {help}', f'# TYPE {p}_{name} {type}', f'{p}_{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, top_queries=5):
+        """A short plain-text digest for the $metrics command."""
+        uptime = int(time.time() - self.started)
+        lines = [f'Uptime: {uptime // 3600}h {uptime % 3600 // 60}m']
+        memory = resident_memory()
+        if memory is not None:
+            lines[0] += f', memory: {memory / 2**20:.0f} MB'
+
+        per_command = defaultdict(lambda: [Histogram(), 0])
+        for (command, status), histogram in self.commands.items():
+            merged, failed = per_command[command]
+            for i, count in enumerate(histogram.counts):
+                merged.counts[i] += count
+            merged.count += histogram.count
+            merged.sum += histogram.sum
+            merged.max = max(merged.max, histogram.max)
+            if status == 'failed':
+                per_command[command][1] += histogram.count
+        if per_command:
+            lines.append('\nCommands (calls, mean, p95):')
+        for command, (histogram, failed) in sorted(per_command.items()):
+            failures = f', {failed} failed' if failed else ''
+            lines.append(f'{command}: {histogram.count}, {histogram.sum / histogram.count * 1000:.1f} ms, '
+                         f'{histogram.quantile(0.95) * 1000:.1f} ms{failures}')
+
+        queries = sorted(self.queries.items(), key=lambda item: item[1].sum, reverse=True)[:top_queries]
+        if queries:
+            lines.append('\nBusiest queries (calls, mean):')
+        for (kind, query, status), histogram in queries:
+            short = query if len(query) <= 60 else query[:57] + '...'
+            lines.append(f'{kind} `{short}`: {histogram.count}, {histogram.sum / histogram.count * 1000:.1f} ms')
+
+        lines.append(f'\nEvent loop lag: p95 {self.loop_lag.quantile(0.95) * 1000:.1f} ms, max {self.loop_lag.max * 1000:.1f} ms')
+        errors = self._error_counter.snapshot()
+        lines.append(f'Errors logged: {sum(errors.values())}')
+        lines += [f'{where}: {count}' for where, count in sorted(errors.items())]
+        return '\n'.join(lines)
@@ -0,0 +1,155 @@
+import logging
+
+
+# Each migration brings the database from the previous user_version to its own
+# position in MIGRATIONS. Append new ones at the end; never edit shipped ones.
+
+def _initial_schema(conn):
+    # IF NOT EXISTS: databases created before migrations existed already have these
+    conn.execute('''CREATE TABLE IF NOT EXISTS players
+                    (discord_id INTEGER PRIMARY KEY, rating REAL, rd REAL, vol REAL, last_match TEXT, matches_played INTEGER, wins INTEGER, losses INTEGER, draws INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS pending_matches
+                    (reporter_id INTEGER, opponent_id INTEGER, result TEXT, timestamp TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS usernames
+                    (discord_id INTEGER PRIMARY KEY, name TEXT, fetched_at REAL)''')
+
+
+def _pending_pairs_and_ladder_indexes(conn):
+    # Unordered pair key, so both report orderings hit the same index entry
+    conn.execute('ALTER TABLE pending_matches ADD COLUMN pair_low INTEGER')
+    conn.execute('ALTER TABLE pending_matches ADD COLUMN pair_high INTEGER')
+    conn.execute('UPDATE pending_matches SET pair_low = MIN(reporter_id, opponent_id), pair_high = MAX(reporter_id, opponent_id)')
+    conn.execute('CREATE INDEX pending_matches_pair ON pending_matches (pair_low, pair_high, reporter_id, timestamp)')
+    conn.execute('CREATE INDEX pending_matches_expiry ON pending_matches (timestamp)')
+    # Covers the ladder queries: walk players by rating and filter without touching the table
+    conn.execute('CREATE INDEX players_ladder ON players (rating DESC, last_match, matches_played)')
+
+
+def _match_history(conn):
+    # Append-only record of every confirmed game; voided games are skipped by recomputes
+    conn.execute('''CREATE TABLE matches
+                    (id INTEGER PRIMARY KEY, reporter_id INTEGER NOT NULL, opponent_id INTEGER NOT NULL, result TEXT NOT NULL, played_at TEXT NOT NULL,
+                     reporter_rating_before REAL, reporter_rd_before REAL, reporter_rating_after REAL, reporter_rd_after REAL,
+                     opponent_rating_before REAL, opponent_rd_before REAL, opponent_rating_after REAL, opponent_rd_after REAL,
+                     voided INTEGER NOT NULL DEFAULT 0)''')
+
+
+def _rating_periods(conn):
+    # Matches confirmed in rating period mode stay unrated until their period closes
+    conn.execute('ALTER TABLE matches ADD COLUMN rated INTEGER NOT NULL DEFAULT 1')
+    conn.execute('ALTER TABLE matches ADD COLUMN period INTEGER')
+    conn.execute('CREATE INDEX matches_unrated ON matches (id) WHERE rated = 0')
+    # Every closed period, including empty ones, so recomputes can replay the idle RD growth
+    conn.execute('''CREATE TABLE rating_periods
+                    (id INTEGER PRIMARY KEY, closed_at TEXT NOT NULL, last_match_id INTEGER NOT NULL)''')
+
+
+def _lazy_rd(conn):
+    # When rd was last written (unix epoch); it grows by one step for every rating period
+    # since, computed on read. Stored RDs are up to date as of this migration.
+    conn.execute('ALTER TABLE players ADD COLUMN rd_updated INTEGER')
+    conn.execute("UPDATE players SET rd_updated = CAST(strftime('%s', 'now') AS INTEGER)")
+
+
+def _players_version(conn):
+    # Counts every change to the players table, so a snapshot of it taken at
+    # some version is known to be current as long as the count hasn't moved
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    conn.execute("INSERT INTO meta (key, value) VALUES ('players_version', 0)")
+    _players_version_triggers(conn)
+
+
+def _players_version_triggers(conn):
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''CREATE TRIGGER players_version_{event.lower()} AFTER {event} ON players
+                         BEGIN UPDATE meta SET value = value + 1 WHERE key = 'players_version'; END''')
+
+
+def _epoch(column):
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+
+def _epoch_timestamps(conn):
+    # Times were ISO 8601 text; they become unix epochs, compared and indexed as integers.
+    # SQLite can't change a column's type, so each table is rebuilt (which drops its indexes
+    # and triggers; they are created again).
+    conn.execute('''CREATE TABLE players_new
+                    (discord_id INTEGER PRIMARY KEY, rating REAL, rd REAL, vol REAL, last_match INTEGER, matches_played INTEGER,
+                     wins INTEGER, losses INTEGER, draws INTEGER, rd_updated INTEGER)''')
+    conn.execute(f'''INSERT INTO players_new SELECT discord_id, rating, rd, vol, {_epoch('last_match')}, matches_played,
+                     wins, losses, draws, rd_updated FROM players''')
+    conn.execute('DROP TABLE players')
+    conn.execute('ALTER TABLE players_new RENAME TO players')
+    conn.execute('CREATE INDEX players_ladder ON players (rating DESC, last_match, matches_played)')
+    _players_version_triggers(conn)
+    # Snapshots of the players table taken before this are no longer current
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'players_version'")
+
+    conn.execute('''CREATE TABLE matches_new
+                    (id INTEGER PRIMARY KEY, reporter_id INTEGER NOT NULL, opponent_id INTEGER NOT NULL, result TEXT NOT NULL, played_at INTEGER NOT NULL,
+                     reporter_rating_before REAL, reporter_rd_before REAL, reporter_rating_after REAL, reporter_rd_after REAL,
+                     opponent_rating_before REAL, opponent_rd_before REAL, opponent_rating_after REAL, opponent_rd_after REAL,
+                     voided INTEGER NOT NULL DEFAULT 0, rated INTEGER NOT NULL DEFAULT 1, period INTEGER)''')
+    conn.execute(f'''INSERT INTO matches_new SELECT id, reporter_id, opponent_id, result, {_epoch('played_at')},
+                     reporter_rating_before, reporter_rd_before, reporter_rating_after, reporter_rd_after,
+                     opponent_rating_before, opponent_rd_before, opponent_rating_after, opponent_rd_after,
+                     voided, rated, period FROM matches''')
+    conn.execute('DROP TABLE matches')
+    conn.execute('ALTER TABLE matches_new RENAME TO matches')
+    conn.execute('CREATE INDEX matches_unrated ON matches (id) WHERE rated = 0')
+
+    conn.execute('''CREATE TABLE rating_periods_new
+                    (id INTEGER PRIMARY KEY, closed_at INTEGER NOT NULL, last_match_id INTEGER NOT NULL)''')
+    conn.execute(f"INSERT INTO rating_periods_new SELECT id, {_epoch('closed_at')}, last_match_id FROM rating_periods")
+    conn.execute('DROP TABLE rating_periods')
+    conn.execute('ALTER TABLE rating_periods_new RENAME TO rating_periods')
+
+    # Pending reports get their own id instead of being identified by their timestamp; the
+    # pair columns go, as pairs are only ever looked up in memory
+    conn.execute('''CREATE TABLE pending_matches_new
+                    (id INTEGER PRIMARY KEY, reporter_id INTEGER NOT NULL, opponent_id INTEGER NOT NULL, result TEXT NOT NULL,
+                     timestamp INTEGER NOT NULL)''')
+    conn.execute(f"INSERT INTO pending_matches_new SELECT rowid, reporter_id, opponent_id, result, {_epoch('timestamp')} FROM pending_matches")
+    conn.execute('DROP TABLE pending_matches')
+    conn.execute('ALTER TABLE pending_matches_new RENAME TO pending_matches')
+    conn.execute('CREATE INDEX pending_matches_expiry ON pending_matches (timestamp)')
+
+
+def _player_match_indexes(conn):
+    # A player's games in order, for their rating history
+    conn.execute('CREATE INDEX matches_reporter ON matches (reporter_id, id)')
+    conn.execute('CREATE INDEX matches_opponent ON matches (opponent_id, id)')
+
+
+MIGRATIONS = [
+    _initial_schema,
+    _pending_pairs_and_ladder_indexes,
+    _match_history,
+    _rating_periods,
+    _lazy_rd,
+    _players_version,
+    _epoch_timestamps,
+    _player_match_indexes,
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply every migration newer than the database's user_version, one transaction each."""
+    version = schema_version(conn)
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f'Database schema version {version} is newer than this bot ({len(MIGRATIONS)})')
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        logging.info(f'Applied database migration {number}: {migration.__name__.strip("_")}')
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import aiohttp
+import discord
+
+
+class NameCache:
+    """Resolves discord ids to display names for the leaderboards.
+
+    Names live in an LRU of at most max_size entries, backed by the usernames
+    table. An entry older than ttl is still served, but triggers a refresh in
+    the background (stale-while-revalidate), so only ids that were never seen
+    before make a caller wait on the Discord API. Those are fetched
+    concurrently, at most `concurrency` requests at a time.
+    """
+
+    unknown_name = 'Unknown user'
+    # Returned by _fetch when the API couldn't be reached, as opposed to None for a deleted user
+    unavailable = object()
+
+    def __init__(self, bot, db, max_size=10000, ttl=24 * 60 * 60, concurrency=5):
+        self.bot = bot
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # discord_id -> (name, fetched_at)
+        # Lookups answered from memory, from the usernames table and by the Discord API
+        self.hits = 0
+        self.db_hits = 0
+        self.fetches = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._refreshing = set()
+        self._tasks = set()
+
+    def _remember(self, discord_id, name, fetched_at):
+        self._entries[discord_id] = (name, fetched_at)
+        self._entries.move_to_end(discord_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _fetch(self, discord_id):
+        self.fetches += 1
+        async with self._semaphore:
+            try:
+                user = await self.bot.fetch_user(discord_id)
+            except discord.NotFound:  # fetch_user raises an error if the user doesn't exist
+                return None
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                logging.error(f"Error fetching user {discord_id}: {e!r}")
+                return self.unavailable
+        return user.name
+
+    async def _fetch_and_store(self, ids):
+        names = await asyncio.gather(*(self._fetch(discord_id) for discord_id in ids))
+        now = time.time()
+        resolved, unavailable = {}, []
+        for discord_id, name in zip(ids, names):
+            if name is self.unavailable:
+                unavailable.append(discord_id)
+            if name is None or name is self.unavailable:
+                continue
+            self._remember(discord_id, name, now)
+            resolved[discord_id] = name
+        if resolved:
+            try:
+                await self.db.executemany(
+                    'INSERT OR REPLACE INTO usernames (discord_id, name, fetched_at) VALUES (?, ?, ?)',
+                    [(discord_id, name, now) for discord_id, name in resolved.items()])
+            except Exception as e:
+                logging.error(f"Error storing usernames: {e}")
+        return resolved, unavailable
+
+    async def _refresh(self, ids):
+        try:
+            await self._fetch_and_store(ids)
+        finally:
+            self._refreshing.difference_update(ids)
+
+    def _schedule_refresh(self, ids):
+        ids = [discord_id for discord_id in ids if discord_id not in self._refreshing]
+        if not ids:
+            return
+        self._refreshing.update(ids)
+        task = asyncio.create_task(self._refresh(ids))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def resolve_many(self, ids):
+        """Return {discord_id: name} for every id in ids."""
+        now = time.time()
+        names, stale, missing = {}, [], []
+        for discord_id in dict.fromkeys(ids):
+            user = self.bot.get_user(discord_id)
+            if user is not None:
+                self._remember(discord_id, user.name, now)
+                names[discord_id] = user.name
+                self.hits += 1
+                continue
+            entry = self._entries.get(discord_id)
+            if entry is None:
+                missing.append(discord_id)
+                continue
+            self._entries.move_to_end(discord_id)
+            names[discord_id] = entry[0]
+            self.hits += 1
+            if now - entry[1] > self.ttl:
+                stale.append(discord_id)
+
+        if missing:
+            placeholders = ', '.join('?' * len(missing))
+            rows = await self.db.fetchall(
+                f'SELECT discord_id, name, fetched_at FROM usernames WHERE discord_id IN ({placeholders})', missing)
+            for discord_id, name, fetched_at in rows:
+                self._remember(discord_id, name, fetched_at)
+                names[discord_id] = name
+                self.db_hits += 1
+                if now - fetched_at > self.ttl:
+                    stale.append(discord_id)
+            missing = [discord_id for discord_id in missing if discord_id not in names]
+
+        if stale:
+            self._schedule_refresh(stale)
+        if missing:
+            resolved, unavailable = await self._fetch_and_store(missing)
+            names.update(resolved)
+            # Not reachable right now: a mention still renders as the user's name in Discord
+            for discord_id in unavailable:
+                names[discord_id] = f'<@{discord_id}>'
+            for discord_id in missing:
+                names.setdefault(discord_id, self.unknown_name)
+        return names
+
+    async def resolve(self, discord_id):
+        return (await self.resolve_many([discord_id]))[discord_id]
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from periods import from_epoch, to_epoch
+
+
+PendingReport = namedtuple('PendingReport', ['id', 'reporter_id', 'opponent_id', 'result', 'timestamp'])
+
+
+def pair_key(player_id, other_id):
+    # Each unordered pair of players is stored as (low id, high id)
+    return min(player_id, other_id), max(player_id, other_id)
+
+
+class PendingReports:
+    """Match reports waiting for the opponent's confirmation, held in memory.
+
+    Reports are indexed by unordered player pair and expire exactly `lifetime`
+    after they were made: lookups never return an expired report, and a timer
+    set for the oldest one drops them from memory.
+
+    With a Database given as journal, every change is also queued to the
+    pending_matches table, without waiting for it, so reports survive a
+    restart. With a WriteBehind as well, changes are batched through it
+    instead of each going to the writer thread.
+    """
+
+    def __init__(self, lifetime=timedelta(minutes=20), journal=None, write_behind=None):
+        self.lifetime = lifetime
+        self.journal = journal
+        self.write_behind = write_behind
+        self._pairs = {}  # (low id, high id) -> [PendingReport]
+        self._expiry = []  # heap of (timestamp, sequence, report)
+        self._sequence = itertools.count()
+        self._last_id = 0
+        self._timer = None
+        self.loaded = False
+
+    def __len__(self):
+        return sum(len(reports) for reports in self._pairs.values())
+
+    def _new_id(self):
+        # Microseconds since the epoch, bumped past the last id handed out: unique and increasing across
+        # restarts, and known before the journal insert runs, which it may not do right away
+        self._last_id = max(time.time_ns() // 1000, self._last_id + 1)
+        return self._last_id
+
+    def _journal(self, sql, params, action):
+        if self.journal is None:
+            return
+        if self.write_behind is not None:
+            self.write_behind.queue(sql, params)
+            return
+
+        def log_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                logging.error(f"Error journaling pending match {action}: {future.exception()}")
+
+        self.journal.submit(lambda conn: conn.execute(sql, params), f'journal pending match {action}').add_done_callback(log_failure)
+
+    def _track(self, report):
+        self._pairs.setdefault(pair_key(report.reporter_id, report.opponent_id), []).append(report)
+        heapq.heappush(self._expiry, (report.timestamp, next(self._sequence), report))
+        self._schedule()
+
+    def add(self, reporter_id, opponent_id, result, now=None):
+        report = PendingReport(self._new_id(), reporter_id, opponent_id, result, now or datetime.utcnow())
+        self._track(report)
+        self._journal('INSERT INTO pending_matches (id, reporter_id, opponent_id, result, timestamp) VALUES (?, ?, ?, ?, ?)',
+                      (report.id, reporter_id, opponent_id, result, to_epoch(report.timestamp)), 'insert')
+        return report
+
+    def between(self, player_id, other_id, now=None):
+        """Unexpired reports between the two players, oldest first."""
+        cutoff = (now or datetime.utcnow()) - self.lifetime
+        return [report for report in self._pairs.get(pair_key(player_id, other_id), ()) if report.timestamp > cutoff]
+
+    def _forget(self, report):
+        key = pair_key(report.reporter_id, report.opponent_id)
+        reports = self._pairs.get(key)
+        if not reports or report not in reports:
+            return False
+        reports.remove(report)
+        if not reports:
+            del self._pairs[key]
+        return True
+
+    def remove(self, report, journal=True):
+        """Drop a report; with journal=False the caller deletes the journal row itself."""
+        if not self._forget(report):
+            return False
+        if journal:
+            self._journal(DELETE_JOURNALED, (report.id,), 'delete')
+        return True
+
+    def put_back(self, report):
+        """Track a report taken with remove(journal=False) again; its journal row is still there."""
+        self._track(report)
+
+    def expire(self, now=None):
+        cutoff = (now or datetime.utcnow()) - self.lifetime
+        expired = 0
+        while self._expiry and self._expiry[0][0] <= cutoff:
+            _, _, report = heapq.heappop(self._expiry)
+            # Reports that were confirmed or canceled are already gone
+            if self._forget(report):
+                expired += 1
+        if expired:
+            logging.info(f'Expired {expired} pending match reports.')
+        # Journal rows of expired reports are ignored and cleared at the next load
+
+    def _schedule(self):
+        if not self._expiry:
+            return
+        loop = asyncio.get_running_loop()
+        when = loop.time() + max((self._expiry[0][0] + self.lifetime - datetime.utcnow()).total_seconds(), 0)
+        if self._timer is not None and not self._timer.cancelled() and self._timer.when() <= when:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_at(when, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.expire()
+        self._schedule()
+
+    async def load(self):
+        """Restore unexpired reports from the journal and clear out expired ones."""
+        if self.journal is None or self.loaded:
+            return
+        self.loaded = True
+        cutoff = to_epoch(datetime.utcnow() - self.lifetime)
+        await self.journal.execute('DELETE FROM pending_matches WHERE timestamp <= ?', (cutoff,))
+        rows = await self.journal.fetchall(
+            'SELECT id, reporter_id, opponent_id, result, timestamp FROM pending_matches ORDER BY id')
+        for report_id, reporter_id, opponent_id, result, timestamp in rows:
+            self._last_id = max(self._last_id, report_id)
+            # Reports made before the load are already tracked
+            if all(tracked.id != report_id for tracked in self._pairs.get(pair_key(reporter_id, opponent_id), ())):
+                self._track(PendingReport(report_id, reporter_id, opponent_id, result, from_epoch(timestamp)))
+        logging.info(f'Restored {len(rows)} pending match reports.')
+
+
+DELETE_JOURNALED = 'DELETE FROM pending_matches WHERE id = ?'
+
+
+def delete_journaled(conn, report):
+    conn.execute(DELETE_JOURNALED, (report.id,))
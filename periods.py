@@ -0,0 +1,140 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+import glicko
+
+
+SCORES = {'w': 1, 'l': 0, 'd': 0.5}
+
+
+def to_epoch(moment):
+    # Naive datetimes in this bot are UTC
+    return int(moment.replace(tzinfo=timezone.utc).timestamp())
+
+
+def from_epoch(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+
+def elapsed_periods(since, now, period_length):
+    """Whole rating periods between two epochs (scalars or arrays)."""
+    return (np.asarray(now) - np.asarray(since)) // int(period_length.total_seconds())
+
+
+class PeriodBuffer:
+    """Games confirmed during the open rating period, indexed by player.
+
+    Ratings only change when the period closes, so every game is stored with
+    the opponent's rating and rd from the start of the period. That is all that
+    is needed to show a player's provisional rating at any time.
+    """
+
+    def __init__(self):
+        self._games = {}  # discord_id -> {match_id: (opponent_rating, opponent_rd, score)}
+        self._players = {}  # match_id -> (reporter_id, opponent_id)
+
+    def __len__(self):
+        return len(self._players)
+
+    def add(self, match_id, reporter_id, opponent_id, reporter_before, opponent_before, result):
+        # *_before are the players' (rating, rd) at the start of the period
+        score = SCORES[result]
+        self._games.setdefault(reporter_id, {})[match_id] = (opponent_before[0], opponent_before[1], score)
+        self._games.setdefault(opponent_id, {})[match_id] = (reporter_before[0], reporter_before[1], 1 - score)
+        self._players[match_id] = (reporter_id, opponent_id)
+
+    def load(self, rows):
+        # rows are unrated matches: (id, reporter_id, opponent_id, result,
+        # reporter_rating_before, reporter_rd_before, opponent_rating_before, opponent_rd_before)
+        for row in rows:
+            self.add(row[0], row[1], row[2], (row[4], row[5]), (row[6], row[7]), row[3])
+
+    def clear(self):
+        self._games.clear()
+        self._players.clear()
+
+    def remove(self, match_ids):
+        for match_id in match_ids:
+            players = self._players.pop(match_id, None)
+            if players is None:
+                continue
+            for discord_id in players:
+                games = self._games.get(discord_id)
+                if games is not None:
+                    games.pop(match_id, None)
+                    if not games:
+                        del self._games[discord_id]
+
+    def has_games(self, discord_id):
+        return discord_id in self._games
+
+    def provisional(self, discord_id, rating, rd, vol):
+        """(rating, rd, vol) the player would have if the period closed now."""
+        games = self._games.get(discord_id)
+        if not games:
+            return rating, rd, vol
+        opp_rating, opp_rd, score = zip(*games.values())
+        new_rating, new_rd, new_vol = glicko.rate_period([rating], [rd], [vol], [0] * len(games), opp_rating, opp_rd, score)
+        return float(new_rating[0]), float(new_rd[0]), float(new_vol[0])
+
+
+def close_period(conn, max_rd, period_length, now=None):
+    """Rate every unrated match as one Glicko-2 rating period.
+
+    Participants are rated on all their games of the period at once. Everybody
+    else is left alone: their RD grows lazily, from rd_updated, when it is next
+    read. Runs inside the caller's transaction and returns (closed match ids,
+    {discord_id: (rating, rd, vol)} for participants).
+    """
+    now = now or datetime.utcnow()
+    closed_at = to_epoch(now)
+    last_match_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM matches').fetchone()[0]
+    period = conn.execute('INSERT INTO rating_periods (closed_at, last_match_id) VALUES (?, ?)',
+                          (closed_at, last_match_id)).lastrowid
+
+    matches = conn.execute(
+        'SELECT id, reporter_id, opponent_id, result FROM matches WHERE rated = 0 ORDER BY id').fetchall()
+    if not matches:
+        return [], {}
+
+    players = conn.execute(
+        'SELECT discord_id, rating, rd, vol, rd_updated FROM players WHERE discord_id IN '
+        '(SELECT reporter_id FROM matches WHERE rated = 0 UNION SELECT opponent_id FROM matches WHERE rated = 0)').fetchall()
+    return rate_matches(conn, matches, players, period, closed_at, max_rd, period_length)
+
+
+def rate_matches(conn, matches, players, period, closed_at, max_rd, period_length):
+    """Rate matches together as rating period `period`, closed at the epoch closed_at.
+
+    matches are (id, reporter_id, opponent_id, result) rows and players the
+    (discord_id, rating, rd, vol, rd_updated) rows of everyone in them.
+    Updates both tables and returns what close_period returns.
+    """
+    slots = {row[0]: slot for slot, row in enumerate(players)}
+    matches = [row for row in matches if row[1] in slots and row[2] in slots]
+    ids, rating, rd, vol, rd_updated = (np.array(column) for column in zip(*players))
+    # Catch up on the periods sat out before this one; rate_period adds this period's growth
+    rd = glicko.inflate_rd(rd, vol, elapsed_periods(rd_updated, closed_at, period_length) - 1, max_rd)
+
+    a = np.array([slots[row[1]] for row in matches], dtype=np.intp)
+    b = np.array([slots[row[2]] for row in matches], dtype=np.intp)
+    score = np.array([SCORES[row[3]] for row in matches])
+    new_rating, new_rd, new_vol = glicko.rate_period(
+        rating, rd, vol,
+        np.concatenate([a, b]),
+        np.concatenate([rating[b], rating[a]]),
+        np.concatenate([rd[b], rd[a]]),
+        np.concatenate([score, 1 - score]))
+
+    conn.executemany('UPDATE players SET rating = ?, rd = ?, vol = ?, rd_updated = ? WHERE discord_id = ?',
+                     zip(new_rating.tolist(), new_rd.tolist(), new_vol.tolist(), [closed_at] * len(ids), ids.tolist()))
+    conn.executemany(
+        'UPDATE matches SET rated = 1, period = ?, reporter_rating_after = ?, reporter_rd_after = ?, '
+        'opponent_rating_after = ?, opponent_rd_after = ? WHERE id = ?',
+        zip([period] * len(matches), new_rating[a].tolist(), new_rd[a].tolist(),
+            new_rating[b].tolist(), new_rd[b].tolist(), [row[0] for row in matches]))
+
+    updated = {discord_id: (r, d, v) for discord_id, r, d, v in
+               zip(ids.tolist(), new_rating.tolist(), new_rd.tolist(), new_vol.tolist())}
+    return [row[0] for row in matches], updated
@@ -0,0 +1,184 @@
+import logging
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+
+PlayerRow = namedtuple('PlayerRow', ['discord_id', 'rating', 'rd', 'vol', 'rd_updated', 'last_match',
+                                     'wins', 'losses', 'draws', 'matches_played'])
+
+# Column name and type; times are unix epochs
+COLUMNS = [
+    ('discord_id', np.int64),
+    ('rating', np.float64),
+    ('rd', np.float64),
+    ('vol', np.float64),
+    ('rd_updated', np.int64),
+    ('last_match', np.int64),
+    ('wins', np.int32),
+    ('losses', np.int32),
+    ('draws', np.int32),
+    ('matches_played', np.int32),
+]
+
+# Snapshot file: magic, players_version of the database it was taken from, player count,
+# then every column's values back to back in COLUMNS order
+SNAPSHOT_MAGIC = b'GLKPLRS1'
+_HEADER = struct.Struct('<8sqq')
+
+
+def players_version(conn):
+    # Bumped by triggers on every change to the players table, see migrations._players_version
+    return conn.execute("SELECT value FROM meta WHERE key = 'players_version'").fetchone()[0]
+
+
+def scan_players(conn, chunk_size=50000):
+    """Read the whole players table as (players_version, {column: array}).
+
+    Runs in its own read transaction, so the version matches the rows; conn
+    must be in autocommit mode.
+    """
+    conn.execute('BEGIN')
+    try:
+        return _scan_players(conn, chunk_size)
+    finally:
+        conn.execute('COMMIT')
+
+
+def _scan_players(conn, chunk_size):
+    version = players_version(conn)
+    count = conn.execute('SELECT COUNT(*) FROM players').fetchone()[0]
+    columns = {name: np.empty(count, dtype) for name, dtype in COLUMNS}
+    cursor = conn.execute(
+        'SELECT discord_id, rating, rd, vol, COALESCE(rd_updated, last_match), last_match, wins, losses, draws, matches_played FROM players')
+    start = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for (name, dtype), values in zip(COLUMNS, zip(*rows)):
+            columns[name][start:start + len(rows)] = values
+        start += len(rows)
+    return version, {name: column[:start] for name, column in columns.items()}
+
+
+def write_snapshot(path, version, columns):
+    # Written next to the target and renamed over it, so a crash never leaves a torn snapshot
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(_HEADER.pack(SNAPSHOT_MAGIC, version, len(columns['discord_id'])))
+        for name, dtype in COLUMNS:
+            file.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def read_snapshot(path):
+    """(players_version, {column: read-only memory-mapped array}), or None if there is no usable snapshot."""
+    if not os.path.exists(path):
+        return None
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, count = _HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or len(data) != _HEADER.size + count * sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS):
+        return None
+    columns = {}
+    offset = _HEADER.size
+    for name, dtype in COLUMNS:
+        size = count * np.dtype(dtype).itemsize
+        columns[name] = data[offset:offset + size].view(dtype)
+        offset += size
+    return version, columns
+
+
+class PlayerStore:
+    """Hot player state held in memory, one numpy array per column.
+
+    A dict maps discord_id to the player's slot in the arrays, which grow by
+    doubling, so a player costs 64 bytes of column data plus the dict entry.
+    SQLite stays the durable copy: callers write there first and then apply
+    the committed values here.
+    """
+
+    def __init__(self, capacity=1024):
+        self._slots = {}
+        self._columns = {name: np.zeros(capacity, dtype) for name, dtype in COLUMNS}
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, discord_id):
+        return discord_id in self._slots
+
+    def _reserve(self, count):
+        capacity = len(self._columns['discord_id'])
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+        for name, column in self._columns.items():
+            grown = np.zeros(capacity, column.dtype)
+            grown[:len(self._slots)] = column[:len(self._slots)]
+            self._columns[name] = grown
+
+    def fill(self, columns):
+        """Replace every player with the given {column: array}."""
+        count = len(columns['discord_id'])
+        self._slots = {}
+        self._reserve(max(count, 1))
+        for name, _ in COLUMNS:
+            self._columns[name][:count] = columns[name]
+        self._slots = dict(zip(self._columns['discord_id'][:count].tolist(), range(count)))
+
+    def get(self, discord_id):
+        slot = self._slots.get(discord_id)
+        if slot is None:
+            return None
+        return PlayerRow(*(self._columns[name][slot].item() for name, _ in COLUMNS))
+
+    def put(self, row):
+        """Insert or overwrite a player from a PlayerRow."""
+        slot = self._slots.get(row.discord_id)
+        if slot is None:
+            slot = len(self._slots)
+            self._reserve(slot + 1)
+            self._slots[row.discord_id] = slot
+        for (name, _), value in zip(COLUMNS, row):
+            self._columns[name][slot] = value
+
+    def update(self, discord_id, **values):
+        slot = self._slots[discord_id]
+        for name, value in values.items():
+            self._columns[name][slot] = value
+
+    def column(self, name):
+        """Read-only view of one column, in slot order."""
+        view = self._columns[name][:len(self._slots)]
+        view.flags.writeable = False
+        return view
+
+    def load(self, conn, snapshot_path):
+        """Fill from the snapshot when it matches the database, otherwise scan the table and snapshot it.
+
+        conn must be in autocommit mode. Returns True for a warm start.
+        """
+        try:
+            snapshot = read_snapshot(snapshot_path)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading player snapshot {snapshot_path}: {e}")
+            snapshot = None
+        if snapshot is not None and snapshot[0] == players_version(conn):
+            self.fill(snapshot[1])
+            return True
+
+        version, columns = scan_players(conn)
+        self.fill(columns)
+        try:
+            write_snapshot(snapshot_path, version, columns)
+        except OSError as e:
+            logging.error(f"Error writing player snapshot {snapshot_path}: {e}")
+        return False
@@ -0,0 +1,188 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import time
+import tracemalloc
+import zipfile
+from collections import defaultdict, deque, namedtuple
+
+
+# A profiled command invocation: the cProfile stats dict, the top allocation sites as
+# ((filename, lineno), size, count) still held when it finished, and its peak traced memory
+Sample = namedtuple('Sample', ['command', 'seconds', 'stats', 'allocations', 'peak_memory'])
+
+
+class CommandProfiler:
+    """Profiles a random fraction of command invocations with cProfile and tracemalloc.
+
+    start() and stop() bracket a command; they are meant for the bot's
+    before/after invoke hooks. While rate is 0 start() is one comparison.
+    Only one command is profiled at a time, since both profilers watch the
+    whole thread: anything else the event loop runs meanwhile is counted too.
+    The last `keep` samples are kept in a ring buffer and aggregated per
+    command by hotspots(), allocation_sites() and dump().
+    """
+
+    def __init__(self, rate=0.0, keep=200, top_allocations=25):
+        self.rate = rate
+        self.top_allocations = top_allocations
+        self.samples = deque(maxlen=keep)
+        self._active = None  # (token, command, profile, started)
+        self._tokens = 0
+
+    def start(self, command):
+        """Begin profiling this invocation if it is sampled; returns a token for stop(), or None."""
+        if not self.rate or self._active is not None or random.random() >= self.rate:
+            return None
+        self._tokens += 1
+        tracemalloc.start()
+        profile = cProfile.Profile()
+        self._active = (self._tokens, command, profile, time.perf_counter())
+        profile.enable()
+        return self._tokens
+
+    def stop(self, token):
+        if token is None or self._active is None or self._active[0] != token:
+            return
+        _, command, profile, started = self._active
+        profile.disable()
+        seconds = time.perf_counter() - started
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._active = None
+
+        profile.create_stats()
+        allocations = [((stat.traceback[0].filename, stat.traceback[0].lineno), stat.size, stat.count)
+                       for stat in snapshot.statistics('lineno')[:self.top_allocations]]
+        self.samples.append(Sample(command, seconds, profile.stats, allocations, peak))
+
+    def clear(self):
+        self.samples.clear()
+
+    def commands(self, samples=None):
+        """{command: number of samples}."""
+        counts = defaultdict(int)
+        for sample in self._samples(samples):
+            counts[sample.command] += 1
+        return dict(counts)
+
+    def stats(self, command, samples=None):
+        """pstats.Stats of every sample of the command, merged, or None."""
+        merged = None
+        for sample in self._samples(samples):
+            if sample.command != command:
+                continue
+            if merged is None:
+                merged = pstats.Stats(_StatsHolder(sample.stats))
+            else:
+                merged.add(_StatsHolder(sample.stats))
+        return merged
+
+    def hotspots(self, command, count=5):
+        """[(function, own seconds, cumulative seconds)] per invocation, of the functions with the most own time."""
+        samples = self._samples()
+        stats = self.stats(command, samples)
+        if stats is None:
+            return []
+        invocations = self.commands(samples)[command]
+        # By own time: the largest cumulative times are the event loop's frames around everything
+        own = sorted(((func, tt / invocations, ct / invocations) for func, (_, _, tt, ct, _) in stats.stats.items()
+                      if not _is_profiler_frame(func)), key=lambda row: row[1], reverse=True)
+        return [(_label(func), tt, ct) for func, tt, ct in own[:count]]
+
+    def allocation_sites(self, command, count=10, samples=None):
+        """[('file:line', bytes, blocks)] still held at the end of the command, summed over its samples."""
+        sites = defaultdict(lambda: [0, 0])
+        for sample in self._samples(samples):
+            if sample.command == command:
+                for site, size, blocks in sample.allocations:
+                    sites[site][0] += size
+                    sites[site][1] += blocks
+        ranked = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:count]
+        return [(f'{filename}:{lineno}', size, blocks) for (filename, lineno), (size, blocks) in ranked]
+
+    def _samples(self, samples=None):
+        # A copy, so the ring buffer can take new samples while this runs in another thread
+        return list(self.samples) if samples is None else samples
+
+    def dump(self, directory):
+        """Write <command>.pstats, <command>.collapsed and <command>.allocations.txt per command.
+
+        The .collapsed files are folded stacks in microseconds for flamegraph.pl
+        or speedscope. Returns a zip of all the files as bytes.
+        """
+        os.makedirs(directory, exist_ok=True)
+        samples = self._samples()
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            for command, invocations in sorted(self.commands(samples).items()):
+                stats = self.stats(command, samples)
+                name = command.replace(' ', '_')
+                stats.dump_stats(os.path.join(directory, f'{name}.pstats'))
+                files = {
+                    f'{name}.collapsed': ''.join(f'{stack} {int(seconds * 1e6)}\n' for stack, seconds in collapsed_stacks(stats.stats)
+                                                 if seconds >= 1e-6),
+                    f'{name}.allocations.txt': f'{invocations} samples of {command}, bytes and blocks still held at the end\n' + ''.join(
+                        f'{size:>12} {blocks:>8}  {site}\n' for site, size, blocks in self.allocation_sites(command, 100, samples)),
+                }
+                for filename, text in files.items():
+                    with open(os.path.join(directory, filename), 'w', encoding='utf-8') as file:
+                        file.write(text)
+                for filename in (f'{name}.pstats', *files):
+                    bundle.write(os.path.join(directory, filename), filename)
+        return archive.getvalue()
+
+
+class _StatsHolder:
+    # pstats.Stats accepts anything with create_stats() and a stats dict
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _is_profiler_frame(func):
+    return func[0] == __file__ or func[2] in ("<method 'disable' of '_lsprof.Profiler' objects>",)
+
+
+def _label(func):
+    filename, lineno, name = func
+    if filename == '~':
+        return name
+    return f'{name} ({os.path.basename(filename)}:{lineno})'
+
+
+def collapsed_stacks(stats, max_depth=64, min_seconds=1e-6):
+    """[(semicolon separated stack, own seconds)] rebuilt from a cProfile stats dict.
+
+    cProfile only records caller/callee pairs, so a function's time is split
+    over its callers in proportion to the time each call edge took. Paths
+    worth less than min_seconds are dropped.
+    """
+    callees = defaultdict(list)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller].append((func, edge[3]))
+    stacks = defaultdict(float)
+
+    def visit(func, stack, share):
+        _, _, tt, ct, _ = stats[func]
+        stack = stack + [_label(func)]
+        stacks[';'.join(stack)] += tt * share
+        if len(stack) >= max_depth:
+            return
+        for callee, edge_time in callees[func]:
+            callee_time = stats[callee][3]
+            if callee_time <= 0 or edge_time * share < min_seconds or _label(callee) in stack:
+                continue
+            visit(callee, stack, share * edge_time / callee_time)
+
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers and not _is_profiler_frame(func):
+            visit(func, [], 1.0)
+    return sorted(stacks.items())
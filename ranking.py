@@ -0,0 +1,236 @@
+import heapq
+import random
+from datetime import timedelta
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+class IndexableSkipList:
+    """Sorted list of unique keys with O(log n) insert, remove, rank and index.
+
+    Every link stores how many positions it skips, so positional lookups can
+    descend the levels the same way key lookups do.
+    """
+
+    max_levels = 32
+
+    def __init__(self):
+        self.size = 0
+        self.head = _Node(None, self.max_levels)
+
+    def __len__(self):
+        return self.size
+
+    def _chain(self, key):
+        # Last node before key on every level, plus the position of each of them
+        chain = [None] * self.max_levels
+        positions = [0] * self.max_levels
+        node, position = self.head, 0
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            positions[level] = position
+        return chain, positions
+
+    def insert(self, key):
+        chain, positions = self._chain(key)
+        levels = 1
+        while levels < self.max_levels and random.random() < 0.5:
+            levels += 1
+        new = _Node(key, levels)
+        position = positions[0] + 1
+        for level in range(levels):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            skipped = position - positions[level]
+            new.width[level] = prev.width[level] - skipped + 1
+            prev.width[level] = skipped
+        for level in range(levels, self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self._chain(key)
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def bisect_left(self, key):
+        """Number of keys strictly less than key."""
+        _, positions = self._chain(key)
+        return positions[0]
+
+    def _node_at(self, index):
+        node, remaining = self.head, index + 1
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        return self._node_at(index).key
+
+    def islice(self, start, stop):
+        """Yield the keys at positions start..stop-1 in O(log n + k)."""
+        start = max(start, 0)
+        if start >= min(stop, self.size):
+            return
+        node = self._node_at(start)
+        for _ in range(start, min(stop, self.size)):
+            yield node.key
+            node = node.next[0]
+
+
+class RankedView:
+    """One ladder ordering: highest rating first, ties broken by discord_id.
+
+    top_version changes whenever the first top_size places change, and version
+    whenever anything does, so callers can cache anything rendered from them.
+    """
+
+    def __init__(self, top_size=10):
+        self.top_size = top_size
+        self.top_version = 0
+        self.version = 0
+        self._list = IndexableSkipList()
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._list)
+
+    def __contains__(self, discord_id):
+        return discord_id in self._keys
+
+    def _in_top(self, key):
+        return self._list.bisect_left(key) < self.top_size
+
+    def update(self, discord_id, rating):
+        touches_top = False
+        old = self._keys.get(discord_id)
+        if old is not None:
+            touches_top = self._in_top(old)
+            self._list.remove(old)
+        key = (-rating, discord_id)
+        self._list.insert(key)
+        self._keys[discord_id] = key
+        self.version += 1
+        if touches_top or self._in_top(key):
+            self.top_version += 1
+
+    def discard(self, discord_id):
+        key = self._keys.pop(discord_id, None)
+        if key is not None:
+            if self._in_top(key):
+                self.top_version += 1
+            self.version += 1
+            self._list.remove(key)
+
+    def rank(self, discord_id):
+        # 1-based rank, or None when the player isn't on this ladder
+        key = self._keys.get(discord_id)
+        if key is None:
+            return None
+        return self._list.bisect_left(key) + 1
+
+    def range(self, first_rank, last_rank):
+        # [(rank, discord_id, rating)] for the ranks first_rank..last_rank inclusive
+        first_rank = max(first_rank, 1)
+        keys = self._list.islice(first_rank - 1, last_rank)
+        return [(rank, key[1], -key[0]) for rank, key in enumerate(keys, start=first_rank)]
+
+    def top(self, count):
+        return self.range(1, count)
+
+    # Keyset pages: anchored on the (-rating, discord_id) key of a row already
+    # shown rather than on a rank, so a page doesn't repeat or skip players when
+    # ratings change between turns. The anchor doesn't have to be in the list.
+
+    def page_after(self, key, count):
+        """The count rows after key, as range() returns them."""
+        start = self._list.bisect_left(key)
+        if start < len(self._list) and self._list[start] == key:
+            start += 1
+        return self.range(start + 1, start + count)
+
+    def page_before(self, key, count):
+        """The count rows before key, as range() returns them."""
+        end = self._list.bisect_left(key)
+        return self.range(max(end - count, 0) + 1, end)
+
+
+class RankIndex:
+    """In-memory rank index for the active (last 90 days) and all-time ladders.
+
+    Players are placed once they have played min_matches games. The active view
+    also drops players whose last match is older than active_window; those are
+    expired lazily from a heap ordered by last match time.
+    """
+
+    def __init__(self, min_matches=4, active_window=timedelta(days=90)):
+        self.min_matches = min_matches
+        self.active_window = active_window
+        self.active = RankedView()
+        self.all_time = RankedView()
+        self.loaded = False
+        self._last_match = {}
+        self._expiry = []
+
+    def clear(self):
+        self.active = RankedView(self.active.top_size)
+        self.all_time = RankedView(self.all_time.top_size)
+        self.loaded = False
+        self._last_match = {}
+        self._expiry = []
+
+    def load(self, rows, now):
+        # rows are (discord_id, rating, matches_played, last_match). Players already
+        # present were updated by a match that finished while the rows were read.
+        for discord_id, rating, matches_played, last_match in rows:
+            if discord_id not in self.all_time:
+                self.update(discord_id, rating, matches_played, last_match)
+        self.expire(now)
+        self.loaded = True
+
+    def update(self, discord_id, rating, matches_played, last_match):
+        if matches_played < self.min_matches:
+            return
+        self.all_time.update(discord_id, rating)
+        self.active.update(discord_id, rating)
+        if self._last_match.get(discord_id) != last_match:
+            self._last_match[discord_id] = last_match
+            heapq.heappush(self._expiry, (last_match, discord_id))
+
+    def set_rating(self, discord_id, rating):
+        # Rating change without a new match, e.g. when a rating period closes
+        for view in (self.all_time, self.active):
+            if discord_id in view:
+                view.update(discord_id, rating)
+
+    def expire(self, now):
+        cutoff = now - self.active_window
+        while self._expiry and self._expiry[0][0] < cutoff:
+            last_match, discord_id = heapq.heappop(self._expiry)
+            # Entries superseded by a newer match are just skipped
+            if self._last_match.get(discord_id) == last_match:
+                del self._last_match[discord_id]
+                self.active.discard(discord_id)
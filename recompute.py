@@ -0,0 +1,300 @@
+import argparse
+import logging
+import sqlite3
+import time
+from datetime import timedelta
+
+import numpy as np
+
+import glicko
+from migrations import migrate
+from periods import SCORES, elapsed_periods
+
+
+def _waves(reporter_slots, opponent_slots):
+    # Split games into waves in which no player appears twice. A game goes in the
+    # wave after the latest one holding either of its players, so each player's
+    # games are still rated in order.
+    last_wave = {}
+    waves = np.empty(len(reporter_slots), dtype=np.intp)
+    for i, (a, b) in enumerate(zip(reporter_slots.tolist(), opponent_slots.tolist())):
+        wave = max(last_wave.get(a, -1), last_wave.get(b, -1)) + 1
+        last_wave[a] = last_wave[b] = wave
+        waves[i] = wave
+    return waves
+
+
+def recompute(conn, int_rating, int_rd, int_vol, decay_period=timedelta(days=1), chunk_size=50000):
+    """Rebuild every player's rating and record by replaying the matches table.
+
+    Players start from int_rating/int_rd/int_vol and every non-voided match is
+    rated again in id order. Matches that were rated instantly are replayed as
+    their own rating periods; matches of a closed rating period are rated
+    together when the replay reaches the end of that period. Games of the open
+    period are only counted. RDs grow lazily as in the bot, by one step per
+    decay_period (the bot's rating period, if it uses them) since a player was
+    last rated. Matches are streamed chunk_size at a time, so memory is bounded
+    by the player count plus one chunk and one period. The before/after
+    columns of each match are rewritten to the replayed values.
+
+    Runs inside whatever transaction the caller has open. Returns the number
+    of matches replayed.
+    """
+    ids = [row[0] for row in conn.execute('SELECT discord_id FROM players ORDER BY discord_id')]
+    slots = {discord_id: slot for slot, discord_id in enumerate(ids)}
+    count = len(ids)
+    rating = np.full(count, float(int_rating))
+    rd = np.full(count, float(int_rd))
+    vol = np.full(count, float(int_vol))
+    wins = np.zeros(count, dtype=np.int64)
+    losses = np.zeros(count, dtype=np.int64)
+    draws = np.zeros(count, dtype=np.int64)
+    last_match = [None] * count
+    rd_updated = np.zeros(count, dtype=np.int64)
+    rated = np.zeros(count, dtype=bool)
+
+    def grown_rd(players, now):
+        return glicko.inflate_rd(rd[players], vol[players], elapsed_periods(rd_updated[players], now, decay_period), int_rd)
+
+    # Rows waiting for their period to close: (match id, slot a, slot b, score, before values)
+    period_games = []
+    periods = conn.execute('SELECT id, last_match_id, closed_at FROM rating_periods ORDER BY id').fetchall()
+    next_period = 0
+
+    def update_history(match_ids, before, after):
+        conn.executemany(
+            'UPDATE matches SET reporter_rating_before = ?, reporter_rd_before = ?, opponent_rating_before = ?, opponent_rd_before = ?, '
+            'reporter_rating_after = ?, reporter_rd_after = ?, opponent_rating_after = ?, opponent_rd_after = ? WHERE id = ?',
+            zip(*before.T.tolist(), *after.T.tolist(), match_ids))
+
+    def close_replayed_period():
+        nonlocal rating, rd, vol
+        if period_games:
+            match_ids, a, b, score, before = (np.array(column) for column in zip(*period_games))
+        else:
+            match_ids = a = b = np.zeros(0, dtype=np.intp)
+            score = np.zeros(0)
+            before = np.zeros((0, 4))
+        played = np.zeros(count, dtype=bool)
+        played[a] = played[b] = True
+        closed_at = periods[next_period][2]
+        # Same as close_period: catch up on the periods sat out, idle players are left alone
+        rd[played] = glicko.inflate_rd(rd[played], vol[played],
+                                       elapsed_periods(rd_updated[played], closed_at, decay_period) - 1, int_rd)
+        rating, new_rd, vol = glicko.rate_period(
+            rating, rd, vol,
+            np.concatenate([a, b]),
+            np.concatenate([rating[b], rating[a]]),
+            np.concatenate([rd[b], rd[a]]),
+            np.concatenate([score, 1 - score]))
+        rd = np.where(played, new_rd, rd)
+        rd_updated[played] = closed_at
+        rated[played] = True
+        if len(match_ids):
+            update_history(match_ids.tolist(), before, np.column_stack([rating[a], rd[a], rating[b], rd[b]]))
+        period_games.clear()
+
+    def replay_instant(rows):
+        a = np.array([slots[row[1]] for row in rows], dtype=np.intp)
+        b = np.array([slots[row[2]] for row in rows], dtype=np.intp)
+        score = np.array([SCORES[row[3]] for row in rows])
+        played_at = np.array([row[4] for row in rows], dtype=np.int64)
+        before = np.empty((len(rows), 4))
+        after = np.empty((len(rows), 4))
+        waves = _waves(a, b)
+        order = np.argsort(waves, kind='stable')
+        boundaries = np.flatnonzero(np.diff(waves[order])) + 1
+        for games in np.split(order, boundaries):
+            ga, gb = a[games], b[games]
+            rd[ga], rd[gb] = grown_rd(ga, played_at[games]), grown_rd(gb, played_at[games])
+            rd_updated[ga] = rd_updated[gb] = played_at[games]
+            rated[ga] = rated[gb] = True
+            before[games] = np.column_stack([rating[ga], rd[ga], rating[gb], rd[gb]])
+            new_a, new_b = glicko.rate_games(rating[ga], rd[ga], vol[ga], rating[gb], rd[gb], vol[gb], score[games])
+            rating[ga], rd[ga], vol[ga] = new_a
+            rating[gb], rd[gb], vol[gb] = new_b
+            after[games] = np.column_stack([rating[ga], rd[ga], rating[gb], rd[gb]])
+        update_history([row[0] for row in rows], before, after)
+
+    def kind(row):
+        # 'instant', 'period' (rated when its period closed) or 'open' (current period)
+        if not row[6]:
+            return 'open'
+        return 'instant' if row[5] is None else 'period'
+
+    replayed = 0
+    cursor = conn.execute(
+        'SELECT id, reporter_id, opponent_id, result, played_at, period, rated FROM matches WHERE voided = 0 ORDER BY id')
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        known = [row for row in rows if row[1] in slots and row[2] in slots]
+        if len(known) < len(rows):
+            logging.warning(f'Recompute: skipped {len(rows) - len(known)} matches with unregistered players.')
+
+        # Walk the chunk in runs of one kind that don't cross the end of a rating period
+        start = 0
+        while start < len(known):
+            while next_period < len(periods) and periods[next_period][1] < known[start][0]:
+                close_replayed_period()
+                next_period += 1
+            period_end = periods[next_period][1] if next_period < len(periods) else float('inf')
+            run_kind = kind(known[start])
+            end = start + 1
+            while end < len(known) and known[end][0] <= period_end and kind(known[end]) == run_kind:
+                end += 1
+            run = known[start:end]
+
+            if run_kind == 'instant':
+                replay_instant(run)
+            else:
+                for row in run:
+                    a, b = slots[row[1]], slots[row[2]]
+                    grown = grown_rd(np.array([a, b]), row[4])
+                    before = (rating[a], float(grown[0]), rating[b], float(grown[1]))
+                    if run_kind == 'period':
+                        period_games.append((row[0], a, b, SCORES[row[3]], before))
+                    else:
+                        conn.execute('UPDATE matches SET reporter_rating_before = ?, reporter_rd_before = ?, '
+                                     'opponent_rating_before = ?, opponent_rd_before = ? WHERE id = ?', (*before, row[0]))
+            start = end
+
+        a = np.array([slots[row[1]] for row in known], dtype=np.intp)
+        b = np.array([slots[row[2]] for row in known], dtype=np.intp)
+        score = np.array([SCORES[row[3]] for row in known])
+        for side, side_score in ((a, score), (b, 1 - score)):
+            np.add.at(wins, side, side_score == 1)
+            np.add.at(losses, side, side_score == 0)
+            np.add.at(draws, side, side_score == 0.5)
+        for row in known:
+            last_match[slots[row[1]]] = last_match[slots[row[2]]] = row[4]
+        replayed += len(known)
+
+    while next_period < len(periods):
+        close_replayed_period()
+        next_period += 1
+
+    matches_played = wins + losses + draws
+    conn.executemany(
+        'UPDATE players SET rating = ?, rd = ?, vol = ?, wins = ?, losses = ?, draws = ?, matches_played = ?, '
+        'last_match = COALESCE(?, last_match), rd_updated = COALESCE(?, rd_updated) WHERE discord_id = ?',
+        zip(rating.tolist(), rd.tolist(), vol.tolist(), wins.tolist(), losses.tolist(), draws.tolist(),
+            matches_played.tolist(), last_match, np.where(rated, rd_updated, None).tolist(), ids))
+    return replayed
+
+
+def rate_appended(conn, first_id, max_rd, decay_period=timedelta(days=1), chunk_size=50000):
+    """Rate the non-voided matches with id >= first_id on top of the stored ratings.
+
+    Unlike recompute() nothing before first_id is replayed: every player starts
+    from their stored rating, rd, vol and record, which is what importing
+    matches on top of imported players needs. The matches are rated in id
+    order as instant games, as recompute() replays them, growing RDs from
+    rd_updated by one step per decay_period. Players' ratings and records and
+    the matches' before/after columns are updated; players without such
+    matches are left alone.
+
+    Runs inside whatever transaction the caller has open. Returns the number
+    of matches rated.
+    """
+    players = conn.execute('SELECT discord_id, rating, rd, vol, rd_updated FROM players ORDER BY discord_id').fetchall()
+    if not players:
+        return 0
+    ids, rating, rd, vol, rd_updated = (np.array(column) for column in zip(*players))
+    rating, rd, vol = rating.astype(float), rd.astype(float), vol.astype(float)
+    rd_updated = rd_updated.astype(np.int64)
+    slots = {discord_id: slot for slot, discord_id in enumerate(ids.tolist())}
+    count = len(ids)
+    wins = np.zeros(count, dtype=np.int64)
+    losses = np.zeros(count, dtype=np.int64)
+    draws = np.zeros(count, dtype=np.int64)
+    last_match = np.zeros(count, dtype=np.int64)
+    played = np.zeros(count, dtype=bool)
+
+    rated = 0
+    cursor = conn.execute(
+        'SELECT id, reporter_id, opponent_id, result, played_at FROM matches WHERE id >= ? AND voided = 0 ORDER BY id',
+        (first_id,))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        rows = [row for row in rows if row[1] in slots and row[2] in slots]
+        if not rows:
+            continue
+
+        a = np.array([slots[row[1]] for row in rows], dtype=np.intp)
+        b = np.array([slots[row[2]] for row in rows], dtype=np.intp)
+        score = np.array([SCORES[row[3]] for row in rows])
+        played_at = np.array([row[4] for row in rows], dtype=np.int64)
+        before = np.empty((len(rows), 4))
+        after = np.empty((len(rows), 4))
+        waves = _waves(a, b)
+        order = np.argsort(waves, kind='stable')
+        for games in np.split(order, np.flatnonzero(np.diff(waves[order])) + 1):
+            ga, gb = a[games], b[games]
+            for side in (ga, gb):
+                rd[side] = glicko.inflate_rd(rd[side], vol[side],
+                                             elapsed_periods(rd_updated[side], played_at[games], decay_period), max_rd)
+                rd_updated[side] = played_at[games]
+            before[games] = np.column_stack([rating[ga], rd[ga], rating[gb], rd[gb]])
+            new_a, new_b = glicko.rate_games(rating[ga], rd[ga], vol[ga], rating[gb], rd[gb], vol[gb], score[games])
+            rating[ga], rd[ga], vol[ga] = new_a
+            rating[gb], rd[gb], vol[gb] = new_b
+            after[games] = np.column_stack([rating[ga], rd[ga], rating[gb], rd[gb]])
+        conn.executemany(
+            'UPDATE matches SET reporter_rating_before = ?, reporter_rd_before = ?, opponent_rating_before = ?, opponent_rd_before = ?, '
+            'reporter_rating_after = ?, reporter_rd_after = ?, opponent_rating_after = ?, opponent_rd_after = ? WHERE id = ?',
+            zip(*before.T.tolist(), *after.T.tolist(), [row[0] for row in rows]))
+
+        for side, side_score in ((a, score), (b, 1 - score)):
+            np.add.at(wins, side, side_score == 1)
+            np.add.at(losses, side, side_score == 0)
+            np.add.at(draws, side, side_score == 0.5)
+            np.maximum.at(last_match, side, played_at)
+        played[a] = played[b] = True
+        rated += len(rows)
+
+    p = np.flatnonzero(played)
+    conn.executemany(
+        'UPDATE players SET rating = ?, rd = ?, vol = ?, rd_updated = ?, wins = wins + ?, losses = losses + ?, draws = draws + ?, '
+        'matches_played = matches_played + ?, last_match = MAX(COALESCE(last_match, 0), ?) WHERE discord_id = ?',
+        zip(rating[p].tolist(), rd[p].tolist(), vol[p].tolist(), rd_updated[p].tolist(), wins[p].tolist(),
+            losses[p].tolist(), draws[p].tolist(), (wins + losses + draws)[p].tolist(), last_match[p].tolist(),
+            ids[p].tolist()))
+    return rated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild every rating in players.db from the match history. Stop the bot first.')
+    parser.add_argument('database', nargs='?', default='players.db')
+    parser.add_argument('--rating', type=float, default=1400, help='starting rating (int_rating of the Ladder in ladder.py)')
+    parser.add_argument('--rd', type=float, default=350, help='starting and maximum rating deviation (int_rd of the Ladder in ladder.py)')
+    parser.add_argument('--vol', type=float, default=0.06, help='starting volatility (int_vol of the Ladder in ladder.py)')
+    parser.add_argument('--void', type=int, action='append', default=[], metavar='MATCH_ID',
+                        help='mark a match as voided before replaying; may be repeated')
+    parser.add_argument('--decay-hours', type=float, default=24,
+                        help='hours per RD growth step (rating_period, or rd_decay_period, of the Ladder in ladder.py)')
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(args.database, isolation_level=None)
+    migrate(conn)
+    started = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('UPDATE matches SET voided = 1 WHERE id = ?', [(match_id,) for match_id in args.void])
+        replayed = recompute(conn, args.rating, args.rd, args.vol, timedelta(hours=args.decay_hours), args.chunk_size)
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    conn.close()
+    logging.info(f'Replayed {replayed} matches in {time.perf_counter() - started:.1f}s.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import io
+import re
+from datetime import datetime
+
+from periods import SCORES, rate_matches, to_epoch
+from transfer import InvalidRow, read_rows, validate_match
+
+
+# Results of a whole tournament round, submitted at once by an organizer. One
+# game per line, the first player's result first:
+#   @alice @bob w        (or l, d, 1-0, 0-1, 1/2-1/2)
+#   123456789 987654321 1-0
+# or a CSV file with reporter_id, opponent_id and result columns, as transfer.py reads.
+
+RESULTS = {'w': 'w', '1-0': 'w', 'l': 'l', '0-1': 'l', 'd': 'd', '1/2-1/2': 'd', '½-½': 'd', '0.5-0.5': 'd', '=': 'd'}
+PLAYER = re.compile(r'<@!?(\d+)>|(\d+)')
+
+
+def _player(token):
+    match = PLAYER.fullmatch(token)
+    if match is None:
+        raise InvalidRow(f'not a player mention or id: {token!r}')
+    return int(match.group(1) or match.group(2))
+
+
+def parse_round(text):
+    """[(reporter_id, opponent_id, result)] from the submitted text; raises InvalidRow naming every bad line."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    if lines and 'reporter_id' in lines[0]:
+        rows = read_rows(io.StringIO('\n'.join(lines)), 'csv')
+        parse = lambda row: validate_match(row, datetime.utcnow())[:3]
+    else:
+        rows = enumerate(lines, start=1)
+        parse = _parse_line
+
+    games, errors = [], []
+    for line_number, row in rows:
+        try:
+            if isinstance(row, InvalidRow):
+                raise row
+            games.append(parse(row))
+        except InvalidRow as e:
+            errors.append(f'line {line_number}: {e}')
+    if errors:
+        raise InvalidRow('\n'.join(errors))
+    if not games:
+        raise InvalidRow('no results given')
+    return games
+
+
+def _parse_line(line):
+    tokens = line.replace(',', ' ').split()
+    if len(tokens) != 3:
+        raise InvalidRow('expected two players and a result')
+    reporter_id, opponent_id = _player(tokens[0]), _player(tokens[1])
+    result = RESULTS.get(tokens[2].lower())
+    if result is None:
+        raise InvalidRow(f'unknown result {tokens[2]!r}')
+    if reporter_id == opponent_id:
+        raise InvalidRow('a player cannot play themselves')
+    return reporter_id, opponent_id, result
+
+
+def apply_round(conn, games, max_rd, period_length, rate, effective_rd, now=None):
+    """Record a round's games and, if rate is set, rate them as one rating period.
+
+    Unrated (rate=False), the games join the open rating period like any
+    confirmed match. Runs inside the caller's transaction. Returns (match ids,
+    {discord_id: players row before the round}, {discord_id: RD grown up to
+    now}, {discord_id: [wins, losses, draws] in the round}, {discord_id:
+    (rating, rd, vol)} of the rated players, played_at epoch).
+    """
+    now = to_epoch(now or datetime.utcnow())
+    ids = sorted({game[0] for game in games} | {game[1] for game in games})
+    players = conn.execute(
+        f"SELECT discord_id, rating, rd, vol, rd_updated, wins, losses, draws, matches_played FROM players "
+        f"WHERE discord_id IN ({', '.join('?' * len(ids))})", ids).fetchall()
+    before = {row[0]: row for row in players}
+    missing = [discord_id for discord_id in ids if discord_id not in before]
+    if missing:
+        raise InvalidRow(f"not registered: {', '.join(f'<@{discord_id}>' for discord_id in missing)}")
+
+    # RD as of now, as finalize_match records it
+    shown_rd = {row[0]: effective_rd(row[2], row[3], row[4], now) for row in players}
+    match_ids = []
+    for reporter_id, opponent_id, result in games:
+        match_ids.append(conn.execute(
+            'INSERT INTO matches (reporter_id, opponent_id, result, played_at, rated, '
+            'reporter_rating_before, reporter_rd_before, opponent_rating_before, opponent_rd_before) '
+            'VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)',
+            (reporter_id, opponent_id, result, now, before[reporter_id][1], shown_rd[reporter_id],
+             before[opponent_id][1], shown_rd[opponent_id])).lastrowid)
+
+    records = {discord_id: [0, 0, 0] for discord_id in ids}
+    for reporter_id, opponent_id, result in games:
+        score = SCORES[result]
+        for discord_id, s in ((reporter_id, score), (opponent_id, 1 - score)):
+            records[discord_id][0 if s == 1 else 1 if s == 0 else 2] += 1
+    conn.executemany(
+        'UPDATE players SET last_match = ?, matches_played = matches_played + ?, wins = wins + ?, losses = losses + ?, '
+        'draws = draws + ? WHERE discord_id = ?',
+        [(now, sum(record), *record, discord_id) for discord_id, record in records.items()])
+
+    updated = {}
+    if rate:
+        # Recorded as a rating period of its own, so recomputes replay the round the same way
+        period = conn.execute('INSERT INTO rating_periods (closed_at, last_match_id) VALUES (?, ?)',
+                              (now, match_ids[-1])).lastrowid
+        _, updated = rate_matches(conn, [(match_id, *game) for match_id, game in zip(match_ids, games)],
+                                  [row[:5] for row in players], period, now, max_rd, period_length)
+    return match_ids, before, shown_rd, records, updated, now
@@ -0,0 +1,105 @@
+import random
+
+import numpy as np
+import pytest
+from glicko2 import Player
+
+import glicko
+
+
+def reference_period(players, games):
+    # Rate one period with glicko2.Player: every game is seen from both sides
+    # against the opponent's pre-period rating and rd.
+    results = {i: ([], [], []) for i in range(len(players))}
+    for a, b, score in games:
+        for me, opp, s in ((a, b, score), (b, a, 1 - score)):
+            results[me][0].append(players[opp][0])
+            results[me][1].append(players[opp][1])
+            results[me][2].append(s)
+    rated = []
+    for i, (rating, rd, vol) in enumerate(players):
+        player = Player(rating, rd, vol)
+        if results[i][0]:
+            player.update_player(*results[i])
+        else:
+            player.did_not_compete()
+        rated.append((player.rating, player.rd, player.vol))
+    return rated
+
+
+def random_players(rng, count):
+    return [(rng.uniform(1000, 2200), rng.uniform(30, 350), rng.uniform(0.04, 0.09)) for _ in range(count)]
+
+
+def assert_close(actual, expected):
+    np.testing.assert_allclose(np.column_stack(actual), np.array(expected), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_rate_period_matches_glicko2(seed):
+    rng = random.Random(seed)
+    players = random_players(rng, rng.randint(2, 30))
+    games = []
+    for _ in range(rng.randint(1, 60)):
+        a, b = rng.sample(range(len(players)), 2)
+        games.append((a, b, rng.choice((1, 0.5, 0))))
+
+    game_player, opp_rating, opp_rd, score = [], [], [], []
+    for a, b, s in games:
+        for me, opp, sc in ((a, b, s), (b, a, 1 - s)):
+            game_player.append(me)
+            opp_rating.append(players[opp][0])
+            opp_rd.append(players[opp][1])
+            score.append(sc)
+    rating, rd, vol = zip(*players)
+
+    assert_close(glicko.rate_period(rating, rd, vol, game_player, opp_rating, opp_rd, score),
+                 reference_period(players, games))
+
+
+def test_rate_period_idle_players_only_grow_rd():
+    players = [(1500, 200, 0.06), (1700, 80, 0.05), (1400, 350, 0.06)]
+    rating, rd, vol = zip(*players)
+    new = glicko.rate_period(rating, rd, vol, [0, 1], [1700, 1500], [80, 200], [0.5, 0.5])
+
+    expected = reference_period(players, [(0, 1, 0.5)])
+    assert_close(new, expected)
+    assert new[0][2] == 1400 and new[2][2] == 0.06
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_rate_games_matches_glicko2(seed):
+    rng = random.Random(seed)
+    count = rng.randint(1, 40)
+    side_a, side_b = random_players(rng, count), random_players(rng, count)
+    scores = [rng.choice((1, 0.5, 0)) for _ in range(count)]
+
+    new_a, new_b = glicko.rate_games(*np.array(side_a).T, *np.array(side_b).T, scores)
+
+    expected_a, expected_b = [], []
+    for a, b, s in zip(side_a, side_b, scores):
+        rated_a, rated_b = reference_period([a, b], [(0, 1, s)])
+        expected_a.append(rated_a)
+        expected_b.append(rated_b)
+    assert_close(new_a, expected_a)
+    assert_close(new_b, expected_b)
+
+
+@pytest.mark.parametrize('periods', [0, 1, 2, 5, 40])
+def test_inflate_rd_matches_did_not_compete(periods):
+    rng = random.Random(periods)
+    players = random_players(rng, 20)
+    rd, vol = np.array([p[1] for p in players]), np.array([p[2] for p in players])
+
+    expected = []
+    for rating, player_rd, player_vol in players:
+        player = Player(rating, player_rd, player_vol)
+        for _ in range(periods):
+            player.did_not_compete()
+        expected.append(min(player.rd, 350))
+
+    np.testing.assert_allclose(glicko.inflate_rd(rd, vol, periods, 350), expected, rtol=0, atol=1e-9)
+
+
+def test_inflate_rd_ignores_negative_periods():
+    assert glicko.inflate_rd(120.0, 0.06, -3, 350) == pytest.approx(120.0)
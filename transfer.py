@@ -0,0 +1,322 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import math
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from migrations import migrate
+from periods import to_epoch
+from recompute import rate_appended
+
+
+# Bulk import and export of players and match results. Everything streams in
+# chunks, so memory stays flat whatever the file size, and an import runs in a
+# single transaction: it is applied completely or not at all. Stop the bot first.
+#
+#   python transfer.py export players players.csv
+#   python transfer.py import players old_ladder.jsonl
+#   python transfer.py import matches results.csv --create-players --replay
+#
+# --replay rates only the imported matches, on top of the ratings and records
+# already stored; use recompute.py to rebuild everything from the match history.
+
+PLAYER_COLUMNS = ['discord_id', 'rating', 'rd', 'vol', 'wins', 'losses', 'draws', 'matches_played', 'last_match', 'rd_updated']
+MATCH_COLUMNS = ['id', 'reporter_id', 'opponent_id', 'result', 'played_at', 'rated', 'period', 'voided',
+                 'reporter_rating_before', 'reporter_rd_before', 'reporter_rating_after', 'reporter_rd_after',
+                 'opponent_rating_before', 'opponent_rd_before', 'opponent_rating_after', 'opponent_rd_after']
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def _format(path, fmt):
+    if fmt:
+        return fmt
+    if path.endswith('.jsonl') or path.endswith('.ndjson'):
+        return 'jsonl'
+    if path.endswith('.csv'):
+        return 'csv'
+    raise SystemExit(f'Cannot tell the format of {path}; pass --format csv or --format jsonl')
+
+
+def read_rows(file, fmt):
+    """Yield (line number, dict) for every row of a CSV or JSONL file."""
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            # Empty cells mean "not given", like a missing JSON key
+            yield reader.line_num, {key: value for key, value in row.items() if value not in ('', None)}
+        return
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, InvalidRow(f'not valid JSON: {e}')
+            continue
+        yield line_number, row if isinstance(row, dict) else InvalidRow('not a JSON object')
+
+
+def write_rows(file, fmt, columns, rows):
+    if fmt == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            file.write(json.dumps(dict(zip(columns, row))) + '\n')
+
+
+def _number(row, key, kind, default=None, minimum=None):
+    value = row.get(key, default)
+    if value is None:
+        raise InvalidRow(f'missing {key}')
+    try:
+        number = kind(value)
+    except (TypeError, ValueError):
+        raise InvalidRow(f'{key} is not a valid {kind.__name__}: {value!r}')
+    if kind is float and not math.isfinite(number):
+        raise InvalidRow(f'{key} is not finite: {value!r}')
+    if minimum is not None and number < minimum:
+        raise InvalidRow(f'{key} must be at least {minimum}: {value!r}')
+    return number
+
+
+def _timestamp(row, key, default):
+    # Unix epoch seconds, as exported, or ISO 8601 text (UTC unless it has an offset)
+    value = row.get(key)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        moment = datetime.fromisoformat(str(value))
+    except ValueError:
+        raise InvalidRow(f'{key} is neither a unix epoch nor an ISO 8601 timestamp: {value!r}')
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return to_epoch(moment)
+
+
+def validate_player(row, defaults, now):
+    """(discord_id, rating, rd, vol, wins, losses, draws, matches_played, last_match, rd_updated, name)."""
+    int_rating, int_rd, int_vol = defaults
+    wins = _number(row, 'wins', int, 0, minimum=0)
+    losses = _number(row, 'losses', int, 0, minimum=0)
+    draws = _number(row, 'draws', int, 0, minimum=0)
+    rd = _number(row, 'rd', float, int_rd)
+    if not 0 < rd <= int_rd:
+        raise InvalidRow(f'rd must be in (0, {int_rd}]: {rd}')
+    vol = _number(row, 'vol', float, int_vol)
+    if vol <= 0:
+        raise InvalidRow(f'vol must be positive: {vol}')
+    return (_number(row, 'discord_id', int, minimum=1), _number(row, 'rating', float, int_rating), rd, vol,
+            wins, losses, draws, wins + losses + draws, _timestamp(row, 'last_match', to_epoch(now)),
+            _number(row, 'rd_updated', int, to_epoch(now)), row.get('name'))
+
+
+def validate_match(row, now):
+    """(reporter_id, opponent_id, result, played_at, voided)."""
+    reporter_id = _number(row, 'reporter_id', int, minimum=1)
+    opponent_id = _number(row, 'opponent_id', int, minimum=1)
+    if reporter_id == opponent_id:
+        raise InvalidRow('a player cannot play themselves')
+    result = str(row.get('result', '')).lower()
+    if result not in ('w', 'l', 'd'):
+        raise InvalidRow(f"result must be 'w', 'l' or 'd': {row.get('result')!r}")
+    voided = _number(row, 'voided', int, 0)
+    return reporter_id, opponent_id, result, _timestamp(row, 'played_at', to_epoch(now)), int(bool(voided))
+
+
+def _valid_chunks(rows, validate, strict, chunk_size, stats):
+    # Validate lazily and hand out lists of at most chunk_size good rows
+    def valid():
+        for line_number, row in rows:
+            try:
+                if isinstance(row, InvalidRow):
+                    raise row
+                yield validate(row)
+            except InvalidRow as e:
+                if strict:
+                    raise SystemExit(f'Line {line_number}: {e}; nothing was imported')
+                stats['rejected'] += 1
+                if stats['rejected'] <= 20:
+                    logging.warning(f'Line {line_number}: {e}; skipped')
+
+    good = valid()
+    while True:
+        chunk = list(itertools.islice(good, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_players(conn, rows, defaults, replace=False, strict=False, chunk_size=10000):
+    """Insert validated player rows; existing players are kept unless replace is set."""
+    stats = {'imported': 0, 'rejected': 0, 'kept_existing': 0}
+    now = datetime.utcnow()
+    conflict = ('DO UPDATE SET rating = excluded.rating, rd = excluded.rd, vol = excluded.vol, wins = excluded.wins, '
+                'losses = excluded.losses, draws = excluded.draws, matches_played = excluded.matches_played, '
+                'last_match = excluded.last_match, rd_updated = excluded.rd_updated') if replace else 'DO NOTHING'
+    for chunk in _valid_chunks(rows, lambda row: validate_player(row, defaults, now), strict, chunk_size, stats):
+        # rowcount, unlike total_changes, leaves out the rows changed by triggers
+        changed = conn.executemany(
+            'INSERT INTO players (discord_id, rating, rd, vol, wins, losses, draws, matches_played, last_match, rd_updated) '
+            f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (discord_id) {conflict}',
+            (row[:10] for row in chunk)).rowcount
+        stats['imported'] += changed
+        stats['kept_existing'] += len(chunk) - changed
+        named = [(row[0], row[10], time.time()) for row in chunk if row[10]]
+        if named:
+            conn.executemany('INSERT OR REPLACE INTO usernames (discord_id, name, fetched_at) VALUES (?, ?, ?)', named)
+    return stats
+
+
+def import_matches(conn, rows, defaults, create_players=False, strict=False, chunk_size=10000):
+    """Append validated match rows to the history, in file order.
+
+    Matches between unregistered players are rejected, unless create_players
+    is set, which registers them at the starting rating. Matches already in
+    the history before this import (same players, result and played_at) are
+    skipped, so importing a file again adds nothing. Ratings and records are
+    not touched; rate the new matches with recompute.rate_appended.
+    """
+    stats = {'imported': 0, 'rejected': 0, 'players_created': 0, 'already_present': 0}
+    now = datetime.utcnow()
+    int_rating, int_rd, int_vol = defaults
+    # Duplicates within the file are kept: without played_at, repeated games all get the same time
+    first_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM matches').fetchone()[0]
+    for chunk in _valid_chunks(rows, lambda row: validate_match(row, now), strict, chunk_size, stats):
+        fresh = [row for row in chunk if conn.execute(
+            'SELECT 1 FROM matches WHERE reporter_id = ? AND opponent_id = ? AND result = ? AND played_at = ? AND id < ?',
+            (*row[:4], first_id)).fetchone() is None]
+        stats['already_present'] += len(chunk) - len(fresh)
+        chunk = fresh
+        ids = list({row[0] for row in chunk} | {row[1] for row in chunk})
+        known = set()
+        # Stay well under SQLite's limit on bound parameters
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            known.update(row[0] for row in conn.execute(
+                f"SELECT discord_id FROM players WHERE discord_id IN ({', '.join('?' * len(batch))})", batch))
+        if create_players:
+            missing = set(ids) - known
+            conn.executemany(
+                'INSERT INTO players (discord_id, rating, rd, vol, last_match, matches_played, wins, losses, draws, rd_updated) '
+                'VALUES (?, ?, ?, ?, ?, 0, 0, 0, 0, ?)',
+                [(discord_id, int_rating, int_rd, int_vol, to_epoch(now), to_epoch(now)) for discord_id in missing])
+            stats['players_created'] += len(missing)
+        else:
+            rejected = [row for row in chunk if row[0] not in known or row[1] not in known]
+            if rejected and strict:
+                raise SystemExit(f'Match {rejected[0][:3]} involves an unregistered player; nothing was imported')
+            if rejected:
+                logging.warning(f'Skipped {len(rejected)} matches involving unregistered players.')
+                stats['rejected'] += len(rejected)
+                chunk = [row for row in chunk if row[0] in known and row[1] in known]
+        conn.executemany('INSERT INTO matches (reporter_id, opponent_id, result, played_at, voided, rated) VALUES (?, ?, ?, ?, ?, 1)',
+                         chunk)
+        stats['imported'] += len(chunk)
+    return stats
+
+
+def export(conn, table, file, fmt, chunk_size=10000):
+    columns = PLAYER_COLUMNS if table == 'players' else MATCH_COLUMNS
+    order = 'discord_id' if table == 'players' else 'id'
+    cursor = conn.execute(f'SELECT {", ".join(columns)} FROM {table} ORDER BY {order}')
+    exported = 0
+
+    def rows():
+        nonlocal exported
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                return
+            exported += len(chunk)
+            yield from chunk
+
+    write_rows(file, fmt, columns, rows())
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import or export players and match results. Stop the bot first.')
+    parser.add_argument('--database', default='players.db')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='default: from the file extension')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--rating', type=float, default=1400, help='starting rating (int_rating of the Ladder in ladder.py)')
+    parser.add_argument('--rd', type=float, default=350, help='starting and maximum rating deviation (int_rd of the Ladder in ladder.py)')
+    parser.add_argument('--vol', type=float, default=0.06, help='starting volatility (int_vol of the Ladder in ladder.py)')
+    actions = parser.add_subparsers(dest='action', required=True)
+
+    export_parser = actions.add_parser('export', help='write a table to a file, or - for stdout')
+    export_parser.add_argument('table', choices=['players', 'matches'])
+    export_parser.add_argument('file')
+
+    import_parser = actions.add_parser('import', help='read rows from a file, or - for stdin')
+    import_parser.add_argument('table', choices=['players', 'matches'])
+    import_parser.add_argument('file')
+    import_parser.add_argument('--strict', action='store_true', help='abort on the first invalid row instead of skipping it')
+    import_parser.add_argument('--replace', action='store_true', help='players: overwrite existing players instead of keeping them')
+    import_parser.add_argument('--create-players', action='store_true', help='matches: register unknown players at the starting rating')
+    import_parser.add_argument('--replay', action='store_true',
+                               help='matches: afterwards rate the imported matches on top of the stored ratings and records')
+    import_parser.add_argument('--decay-hours', type=float, default=24,
+                               help='hours per RD growth step for --replay (rating_period, or rd_decay_period, of the Ladder in ladder.py)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fmt = _format(args.file, args.format) if args.file != '-' or args.format else 'csv'
+    defaults = (args.rating, args.rd, args.vol)
+    conn = sqlite3.connect(args.database, isolation_level=None)
+    migrate(conn)
+    started = time.perf_counter()
+
+    if args.action == 'export':
+        file = sys.stdout if args.file == '-' else open(args.file, 'w', newline='', encoding='utf-8')
+        try:
+            # One read transaction, so the export is a consistent snapshot
+            conn.execute('BEGIN')
+            exported = export(conn, args.table, file, fmt, args.chunk_size)
+            conn.execute('COMMIT')
+        finally:
+            if file is not sys.stdout:
+                file.close()
+        logging.info(f'Exported {exported} {args.table} in {time.perf_counter() - started:.1f}s.')
+        conn.close()
+        return
+
+    file = sys.stdin if args.file == '-' else open(args.file, newline='', encoding='utf-8')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = read_rows(file, fmt)
+        if args.table == 'players':
+            stats = import_players(conn, rows, defaults, args.replace, args.strict, args.chunk_size)
+        else:
+            first_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM matches').fetchone()[0]
+            stats = import_matches(conn, rows, defaults, args.create_players, args.strict, args.chunk_size)
+            if args.replay:
+                stats['rated'] = rate_appended(conn, first_id, args.rd, timedelta(hours=args.decay_hours), args.chunk_size)
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    conn.execute('COMMIT')
+    conn.close()
+    logging.info(f"Imported {args.table}: {', '.join(f'{key} {value}' for key, value in stats.items())} "
+                 f'in {time.perf_counter() - started:.1f}s.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+
+
+class WriteBehind:
+    """Queues write statements in memory and applies them to the database in batches.
+
+    queue() returns at once, so a command can reply before its write is on
+    disk. The queue is handed to the database's writer thread as one
+    transaction once it holds max_batch statements or its oldest statement is
+    max_delay seconds old, whichever comes first.
+
+    Every statement is first appended to a journal file with a sequence
+    number, and each batch records its last number in the meta table, in the
+    same transaction. If the process dies with statements still queued,
+    recover() applies the journaled ones the database hasn't seen. The journal
+    is not fsynced, so it covers a crashed process, not a crashed machine.
+    """
+
+    def __init__(self, db, journal_path, max_batch=256, max_delay=1.0):
+        self.db = db
+        self.journal_path = journal_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queued = []  # (seq, sql, params)
+        self._timer = None
+        self._seq = recover(db.path, journal_path)
+        self._journal = open(journal_path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self._queued)
+
+    def queue(self, sql, params=()):
+        self._seq += 1
+        self._journal.write(json.dumps([self._seq, sql, list(params)]) + '\n')
+        # Out of the process's buffers, so a crash of the process can't lose it
+        self._journal.flush()
+        self._queued.append((self._seq, sql, params))
+        if len(self._queued) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+
+    def flush(self):
+        """Hand everything queued to the writer thread; returns a future for the commit, or None.
+
+        Writes submitted to the database afterwards are applied after these.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._queued:
+            return None
+        batch, self._queued = self._queued, []
+        future = self.db.submit(lambda conn: _apply(conn, batch), 'write behind batch')
+        future.add_done_callback(lambda done: self._flushed(done, len(batch), batch[-1][0]))
+        return future
+
+    def _flushed(self, future, count, seq):
+        if future.cancelled() or future.exception() is not None:
+            # Their journal lines are dropped too once a later batch commits
+            logging.error(f"Error applying {count} queued writes: {future.exception() if not future.cancelled() else 'cancelled'}")
+            return
+        # Everything journaled is in the database now; later statements would have a higher seq
+        if seq == self._seq:
+            self._journal.truncate(0)
+
+    def close(self):
+        """Apply whatever is still queued. Call after the Database is closed."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._queued = []
+        self._journal.close()
+        recover(self.db.path, self.journal_path)
+
+
+def _apply(conn, batch):
+    for _, sql, params in batch:
+        conn.execute(sql, params)
+    conn.execute("INSERT INTO meta (key, value) VALUES ('write_behind_seq', ?) "
+                 "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (batch[-1][0],))
+
+
+def recover(path, journal_path):
+    """Apply journaled statements the database at path hasn't seen and empty the journal.
+
+    Returns the last sequence number used, to continue numbering from.
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA busy_timeout = 5000')
+        row = conn.execute("SELECT value FROM meta WHERE key = 'write_behind_seq'").fetchone()
+        applied = row[0] if row else 0
+        batch = []
+        if os.path.exists(journal_path):
+            with open(journal_path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        seq, sql, params = json.loads(line)
+                    except ValueError:
+                        # A line cut short by the crash; it was never acknowledged
+                        break
+                    if seq > applied:
+                        batch.append((seq, sql, params))
+        if batch:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                _apply(conn, batch)
+                conn.execute('COMMIT')
+                logging.info(f'Applied {len(batch)} queued writes from {journal_path}.')
+            except sqlite3.Error as e:
+                conn.execute('ROLLBACK')
+                # Kept aside for a look rather than retried at every start
+                logging.error(f"Error applying queued writes from {journal_path}, moved to {journal_path}.failed: {e}")
+                os.replace(journal_path, f'{journal_path}.failed')
+            applied = batch[-1][0]
+    finally:
+        conn.close()
+    if os.path.exists(journal_path):
+        os.truncate(journal_path, 0)
+    return applied